@@ -5,12 +5,21 @@ import os
 import re
 import logging
 import random
+import json
+import time
+import sqlite3
+import hashlib
+import bisect
+import copy
 import asyncio
+import tempfile
+from collections import Counter, OrderedDict
+from html import escape as html_escape
 from typing import Any
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from telethon import TelegramClient
-from telethon import errors
+from telethon import errors, events
 try:
     from dotenv import load_dotenv
     load_dotenv()
@@ -41,6 +50,8 @@ except ValueError:
 #proxy = ('http', '127.0.0.1', 7890)
 # 创建 Telethon 客户端
 client = TelegramClient('message_forwarder_session', API_ID, API_HASH)
+# 限流统一交给 RateLimiter 处理，不使用 Telethon 内置的自动等待
+client.flood_sleep_threshold = 0
 
 # 新增：用于用户账号的 Telethon 客户端（用于历史消息收集）
 user_client = TelegramClient('user', API_ID, API_HASH)
@@ -52,11 +63,6 @@ USER_CLIENT_READY = False
 # 匹配格式：https://t.me/channel_name/message_id 或 https://t.me/c/channel_id/message_id
 MESSAGE_LINK_PATTERN = r'https?://t\.me/(?:c/(\d+)|([^/]+))/(\d+)'
 
-# 存储每个用户最近发送的消息ID，用于批量删除
-user_sent_messages = {}
-# 存储用户发送的指令消息ID
-user_command_messages = {}
-
 # 新增：用户停止批量转发的标志
 user_stop_flags = {}
 
@@ -82,48 +88,489 @@ if not os.path.exists(LINKS_DIR):
 def get_links_file(channel_name: str) -> str:
     return os.path.join(LINKS_DIR, f"{channel_name}_links.txt")
 
-def process_text(text: str) -> str:
-    """处理文本：删除、替换、追加（支持动态配置）"""
-    # 使用动态配置
-    delete_patterns = dynamic_config['delete_patterns']
-    replace_rules = dynamic_config['replace_rules']
-    append_text = dynamic_config['append_text']
-    
-    # 删除内容
-    if delete_patterns:
-        for pat in delete_patterns.split('|'):
-            if pat.strip():
+# ==================== 频道消息索引 ====================
+# 每个帖子一行 JSON（媒体组合并为一行）：
+# {"id": 首条消息id, "gid": grouped_id, "members": [组内所有消息id], "media": 是否含媒体,
+#  "kind": 媒体类型, "date": 时间戳, "len": 文本长度}
+# 元数据单独保存，/listlinks 等只读取元数据，无需逐行统计
+
+def get_index_file(channel_name: str) -> str:
+    return os.path.join(LINKS_DIR, f"{channel_name}_index.jsonl")
+
+def get_index_meta_file(channel_name: str) -> str:
+    return os.path.join(LINKS_DIR, f"{channel_name}_index.meta.json")
+
+def media_kind(msg) -> str:
+    """返回消息的媒体类型，无媒体返回空字符串"""
+    if not msg.media:
+        return ''
+    if msg.photo:
+        return 'photo'
+    if msg.gif:
+        return 'gif'
+    if msg.video:
+        return 'video'
+    if msg.voice:
+        return 'voice'
+    if msg.audio:
+        return 'audio'
+    if msg.sticker:
+        return 'sticker'
+    if msg.document:
+        return 'document'
+    if msg.web_preview:
+        return 'webpage'
+    return type(msg.media).__name__.replace('MessageMedia', '').lower()
+
+def build_index_row(msg) -> dict:
+    return {
+        'id': msg.id,
+        'gid': msg.grouped_id,
+        'members': [msg.id],
+        'media': bool(msg.media),
+        'kind': media_kind(msg),
+        'date': int(msg.date.timestamp()) if msg.date else 0,
+        'len': len(msg.message or ''),
+    }
+
+def merge_index_row(row: dict, msg) -> None:
+    """把同一媒体组的后续消息合并到已有的索引行"""
+    row['members'].append(msg.id)
+    kind = media_kind(msg)
+    if msg.media:
+        if not row['media']:
+            row['kind'] = kind
+        elif row['kind'] != kind:
+            row['kind'] = 'mixed'
+        row['media'] = True
+    row['len'] += len(msg.message or '')
+
+def merge_index_rows(row: dict, other: dict) -> None:
+    """合并同一媒体组被拆成的两行（分段并行收集时，媒体组可能跨越分段边界）"""
+    row['members'].extend(i for i in other['members'] if i not in row['members'])
+    if other['media']:
+        if not row['media']:
+            row['kind'] = other['kind']
+        elif row['kind'] != other['kind']:
+            row['kind'] = 'mixed'
+        row['media'] = True
+    row['len'] += other['len']
+
+def read_index_meta(channel_name: str):
+    """读取索引元数据，不存在返回 None"""
+    meta_file = get_index_meta_file(channel_name)
+    if not os.path.isfile(meta_file):
+        return None
+    with open(meta_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def write_index_meta(channel_name: str, meta: dict) -> None:
+    meta_file = get_index_meta_file(channel_name)
+    tmp_file = meta_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp_file, meta_file)
+
+def iter_index_rows(channel_name: str):
+    """逐行读取索引"""
+    with open(get_index_file(channel_name), 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+# ==================== 文本规则引擎 ====================
+
+# 含反向引用的删除规则合并后组号会错位，只能逐条匹配
+UNMERGEABLE_PATTERN = re.compile(r'\\[1-9]|\(\?P=')
+
+class KeywordMatcher:
+    """Aho-Corasick 多关键词匹配自动机，r/正则/ 形式的条目按正则匹配"""
+
+    def __init__(self, keywords: list):
+        self.keywords = []
+        self.regexes = []
+        # 状态转移表、失败指针、每个状态命中的关键词下标
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [-1]
+        for kw in keywords:
+            kw = kw.strip()
+            if not kw:
+                continue
+            if len(kw) > 3 and kw.startswith('r/') and kw.endswith('/'):
                 try:
-                    text = re.sub(pat.strip(), '', text)
+                    self.regexes.append((kw, re.compile(kw[2:-1])))
                 except re.error as e:
-                    logger.error(f"无效的删除正则: {pat}，错误: {e}")
-    # 替换内容
-    if replace_rules:
-        for rule in replace_rules.split('|'):
+                    logger.error(f"无效的屏蔽正则: {kw}，错误: {e}")
+                continue
+            self._add(kw)
+        self._build()
+
+    def _add(self, keyword: str) -> None:
+        state = 0
+        for ch in keyword:
+            nxt = self.goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[state][ch] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(-1)
+            state = nxt
+        if self.output[state] == -1:
+            self.output[state] = len(self.keywords)
+        self.keywords.append(keyword)
+
+    def _build(self) -> None:
+        # BFS 构建失败指针，并把后缀状态的命中结果向下合并
+        queue = list(self.goto[0].values())
+        head = 0
+        while head < len(queue):
+            state = queue[head]
+            head += 1
+            for ch, nxt in self.goto[state].items():
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                fail = self.goto[f].get(ch, 0)
+                self.fail[nxt] = fail if fail != nxt else 0
+                if self.output[nxt] == -1:
+                    self.output[nxt] = self.output[self.fail[nxt]]
+                queue.append(nxt)
+
+    def __bool__(self) -> bool:
+        return bool(self.keywords or self.regexes)
+
+    def search(self, text: str):
+        """返回文本中最先命中的关键词，未命中返回 None"""
+        if not text:
+            return None
+        if self.keywords:
+            goto, fail, output = self.goto, self.fail, self.output
+            state = 0
+            for ch in text:
+                while state and ch not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(ch, 0)
+                if output[state] != -1:
+                    return self.keywords[output[state]]
+        for kw, regex in self.regexes:
+            if regex.search(text):
+                return kw
+        return None
+
+def load_block_keywords(config: dict) -> list:
+    """合并 ad_keywords（|分隔）和 config.json 中的 block_keywords 列表"""
+    keywords = [k for k in (config.get('ad_keywords') or '').split('|') if k.strip()]
+    block_keywords = config.get('block_keywords') or []
+    if isinstance(block_keywords, str):
+        block_keywords = block_keywords.split('|')
+    keywords.extend(k for k in block_keywords if isinstance(k, str) and k.strip())
+    return keywords
+
+ASTRAL_CHAR = re.compile('[\U00010000-\U0010FFFF]')
+
+def utf16_len(text: str) -> int:
+    """文本的 UTF-16 长度（Telegram 实体的偏移和长度都以 UTF-16 码元计）"""
+    if text.isascii():
+        return len(text)
+    return len(text) + len(ASTRAL_CHAR.findall(text))
+
+class Utf16Index:
+    """字符下标与 UTF-16 偏移的互相换算，只记录 BMP 以外字符（占两个码元）的位置"""
+
+    def __init__(self, text: str):
+        self.astral = [] if text.isascii() else [m.start() for m in ASTRAL_CHAR.finditer(text)]
+        # 每个 BMP 以外字符的 UTF-16 起点
+        self.astral16 = [pos + i for i, pos in enumerate(self.astral)]
+
+    def to_utf16(self, index: int) -> int:
+        if not self.astral:
+            return index
+        return index + bisect.bisect_left(self.astral, index)
+
+    def from_utf16(self, offset: int) -> int:
+        """落在代理对中间的偏移归到该字符的起点"""
+        if not self.astral:
+            return offset
+        return offset - bisect.bisect_left(self.astral16, offset)
+
+def copy_entity(entity, offset: int, length: int):
+    """复制实体并设置新的偏移和长度，保留 url、user_id、document_id 等其他字段"""
+    new_entity = object.__new__(entity.__class__)
+    new_entity.__dict__.update(entity.__dict__)
+    new_entity.offset = offset
+    new_entity.length = length
+    return new_entity
+
+def entity_spans(text: str, entities: list) -> list:
+    """把实体的 UTF-16 偏移换算为字符下标区间，返回 [(start, end, entity)]，越界部分被裁掉"""
+    index = Utf16Index(text)
+    spans = []
+    for entity in entities or []:
+        start = index.from_utf16(entity.offset)
+        end = index.from_utf16(entity.offset + entity.length)
+        start, end = max(start, 0), min(end, len(text))
+        if end > start:
+            spans.append((start, end, entity))
+    return spans
+
+def spans_to_entities(text: str, spans: list) -> list:
+    """entity_spans 的逆操作，把字符下标区间换回 UTF-16 偏移的实体"""
+    index = Utf16Index(text)
+    entities = []
+    for start, end, entity in spans:
+        start, end = index.to_utf16(start), index.to_utf16(end)
+        entities.append(copy_entity(entity, start, end - start))
+    return entities
+
+class TextRules:
+    """编译后的文本处理规则快照，创建后只读，配置变更时整体替换"""
+
+    def __init__(self, config: dict, version: int):
+        self.version = version
+        self.append_text = config.get('append_text') or ''
+
+        # 删除规则：所有正则合并为一个交替正则，一次扫描完成
+        patterns = []
+        for pat in (config.get('delete_patterns') or '').split('|'):
+            pat = pat.strip()
+            if not pat:
+                continue
+            try:
+                re.compile(pat)
+            except re.error as e:
+                logger.error(f"无效的删除正则: {pat}，错误: {e}")
+                continue
+            patterns.append(pat)
+        self.delete_regex = None
+        self.delete_fallback = []
+        if patterns:
+            try:
+                if any(UNMERGEABLE_PATTERN.search(p) for p in patterns):
+                    raise re.error('pattern contains backreference')
+                self.delete_regex = re.compile('|'.join(f'(?:{p})' for p in patterns))
+            except re.error:
+                self.delete_fallback = [re.compile(p) for p in patterns]
+
+        # 替换规则：所有原文本合并为一个多模式匹配器，长词优先，同一原文本以先出现的规则为准
+        self.replace_map = {}
+        for rule in (config.get('replace_rules') or '').split('|'):
             if ':' in rule:
                 old, new = rule.split(':', 1)
-                text = text.replace(old, new)
-    # 追加内容
-    if append_text:
-        text = text.rstrip() + '\n' + append_text
-    return text.strip()
+                if old:
+                    self.replace_map.setdefault(old, new)
+        self.replace_regex = None
+        if self.replace_map:
+            keys = sorted(self.replace_map, key=len, reverse=True)
+            self.replace_regex = re.compile('|'.join(re.escape(k) for k in keys))
+
+        # 广告/屏蔽关键词自动机
+        self.ad_matcher = KeywordMatcher(load_block_keywords(config))
+
+    def apply(self, text: str) -> str:
+        """与发送时相同的处理（包括去掉 ** 标记），/testconfig 的结果与实际发送一致"""
+        return self.transform(text)[0]
+
+    def find_edits(self, text: str, strip_markers: bool) -> list:
+        """在原文本上找出所有编辑 [(start, end, replacement)]，按位置排序且互不重叠
+
+        删除（含 ** 标记）的区间取并集，与删除区间重叠的替换被忽略
+        """
+        deletions = []
+        if self.delete_regex:
+            deletions.extend(m.span() for m in self.delete_regex.finditer(text) if m.end() > m.start())
+        for regex in self.delete_fallback:
+            deletions.extend(m.span() for m in regex.finditer(text) if m.end() > m.start())
+        if strip_markers:
+            pos = text.find('**')
+            while pos != -1:
+                deletions.append((pos, pos + 2))
+                pos = text.find('**', pos + 2)
+        deletions.sort()
+        merged = []
+        for start, end in deletions:
+            if merged and start <= merged[-1][1]:
+                if end > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], end, '')
+            else:
+                merged.append((start, end, ''))
+        if not self.replace_regex:
+            return merged
+
+        edits = []
+        i = 0
+        for m in self.replace_regex.finditer(text):
+            start, end = m.span()
+            while i < len(merged) and merged[i][1] <= start:
+                edits.append(merged[i])
+                i += 1
+            if i < len(merged) and merged[i][0] < end:
+                continue
+            edits.append((start, end, self.replace_map[m.group(0)]))
+        edits.extend(merged[i:])
+        return edits
+
+    def transform(self, text: str, entities: list = None, strip_markers: bool = True):
+        """一次扫描完成删除、替换、去除 ** 和追加，同时修正实体的偏移和长度（UTF-16）
+
+        所有规则都在原文本上匹配，返回 (新文本, 新实体列表, 是否被改写（含去除 **）)。
+        与编辑区间部分重叠的实体收缩到剩余部分，被整段删除的实体丢弃
+        """
+        out, spans, changed = self.transform_spans(text, entity_spans(text, entities), strip_markers)
+        return out, spans_to_entities(out, spans), changed
+
+    def transform_spans(self, text: str, spans: list, strip_markers: bool = True):
+        """transform 的字符下标版本，实体以 [(start, end, entity)] 传入和返回，不做 UTF-16 换算"""
+        edits = self.find_edits(text, strip_markers)
+
+        # 拼接新文本，记录每处编辑在新文本中的起点
+        pieces = []
+        new_starts = []
+        last = 0
+        pos = 0
+        for start, end, replacement in edits:
+            pieces.append(text[last:start])
+            pos += start - last
+            new_starts.append(pos)
+            pieces.append(replacement)
+            pos += len(replacement)
+            last = end
+        pieces.append(text[last:])
+        result = ''.join(pieces)
+
+        edit_starts = [edit[0] for edit in edits]
+
+        def map_pos(p, is_end):
+            k = bisect.bisect_right(edit_starts, p) - 1 if edits else -1
+            if k < 0:
+                return p
+            start, end, replacement = edits[k]
+            if p >= end:
+                return new_starts[k] + len(replacement) + p - end
+            if p > start and is_end:
+                return new_starts[k] + len(replacement)
+            return new_starts[k]
+
+        # 去掉首尾空白后追加内容，实体裁到正文范围内
+        body = result.strip()
+        lead = len(result) - len(result.lstrip())
+        new_spans = []
+        for start, end, entity in spans:
+            start = max(map_pos(start, False) - lead, 0)
+            end = min(map_pos(end, True) - lead, len(body))
+            if end > start:
+                new_spans.append((start, end, entity))
+        out = body
+        if self.append_text:
+            out = (body + '\n' + self.append_text).rstrip()
+            if not body:
+                out = out.lstrip()
+        # 去除 ** 也算改写，否则这类帖子会被原样转发，与渲染发送的结果不一致
+        return out, new_spans, bool(edits) or bool(self.append_text)
+
+# 当前生效的规则快照，只通过 refresh_text_rules 整体替换
+text_rules = None
+text_rules_version = 0
+
+def refresh_text_rules() -> TextRules:
+    """按 dynamic_config 重新编译规则并原子替换当前快照，已运行的任务继续使用旧快照"""
+    global text_rules, text_rules_version
+    text_rules_version += 1
+    text_rules = TextRules(dynamic_config, text_rules_version)
+    return text_rules
+
+def get_text_rules() -> TextRules:
+    """获取当前规则快照，批量任务开始时调用一次并在整个任务中沿用"""
+    return text_rules
 
+refresh_text_rules()
+
+def process_text(text: str, rules: TextRules = None) -> str:
+    """处理文本：删除、替换、追加（支持动态配置）"""
+    return (rules or text_rules).apply(text)
+
+
+# ==================== 用户消息记录 ====================
+# 每个用户最近的消息（机器人发给用户的和用户的指令）保存在 SQLite 中，供 /clear 删除，重启后仍然有效。
+# 每个用户只保留最近的若干条（环形缓冲），超过48小时的消息机器人已无法删除，不再保留；
+# 写入先进入内存队列，攒够一批或间隔一段时间再写盘
+
+TRACK_DB_FILE = os.path.join(LINKS_DIR, 'tracked_messages.db')
+TRACK_MAX_PER_USER = 500  # 每个用户最多保留的消息数，可在 config.json 中用 track_max_per_user 修改
+TRACK_TTL_HOURS = 48  # 消息记录有效期，可在 config.json 中用 track_ttl_hours 修改
+TRACK_FLUSH_BATCH = 200  # 累计多少条记录写盘一次
+TRACK_FLUSH_INTERVAL = 5.0  # 距上次写盘超过多少秒也会写盘
+TRACK_PURGE_INTERVAL = 600  # 清理过期记录的间隔（秒）
+
+class MessageTracker:
+    """按用户记录最近消息 id 的持久化环形缓冲区（SQLite），内存中只保留未写盘的记录"""
+
+    def __init__(self, path: str = TRACK_DB_FILE):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS tracked (user_id INTEGER, message_id INTEGER, ts REAL, '
+                          'PRIMARY KEY (user_id, message_id)) WITHOUT ROWID')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS tracked_ts ON tracked (ts)')
+        self.conn.commit()
+        self.pending = []  # [(user_id, message_id, ts)]
+        self.last_flush = time.monotonic()
+        self.last_purge = 0.0
+
+    def capacity(self) -> int:
+        return int(dynamic_config.get('track_max_per_user', TRACK_MAX_PER_USER))
+
+    def ttl(self) -> float:
+        return float(dynamic_config.get('track_ttl_hours', TRACK_TTL_HOURS)) * 3600
+
+    def add(self, user_id: int, message_ids: list) -> None:
+        now = time.time()
+        self.pending.extend((user_id, message_id, now) for message_id in message_ids)
+        if (len(self.pending) >= TRACK_FLUSH_BATCH
+                or time.monotonic() - self.last_flush >= TRACK_FLUSH_INTERVAL):
+            self.flush()
+
+    def flush(self) -> None:
+        """写入队列中的记录，并把涉及的用户裁剪到上限；定期删除过期记录"""
+        self.last_flush = time.monotonic()
+        if self.pending:
+            pending, self.pending = self.pending, []
+            self.conn.executemany('INSERT OR REPLACE INTO tracked VALUES (?, ?, ?)', pending)
+            capacity = self.capacity()
+            for user_id in {item[0] for item in pending}:
+                self.conn.execute('DELETE FROM tracked WHERE user_id = ? AND message_id NOT IN '
+                                  '(SELECT message_id FROM tracked WHERE user_id = ? '
+                                  'ORDER BY ts DESC, message_id DESC LIMIT ?)', (user_id, user_id, capacity))
+        if self.last_flush - self.last_purge >= TRACK_PURGE_INTERVAL:
+            self.last_purge = self.last_flush
+            self.conn.execute('DELETE FROM tracked WHERE ts < ?', (time.time() - self.ttl(),))
+        self.conn.commit()
+
+    def get(self, user_id: int) -> list:
+        """返回用户有效期内的消息 id，按记录时间排序"""
+        self.flush()
+        return [row[0] for row in self.conn.execute(
+            'SELECT message_id FROM tracked WHERE user_id = ? AND ts >= ? ORDER BY ts, message_id',
+            (user_id, time.time() - self.ttl()))]
+
+    def clear(self, user_id: int) -> None:
+        self.pending = [item for item in self.pending if item[0] != user_id]
+        self.conn.execute('DELETE FROM tracked WHERE user_id = ?', (user_id,))
+        self.conn.commit()
+
+message_tracker = MessageTracker()
 
 async def track_bot_message(user_id, message):
     """跟踪机器人发送的消息，用于后续删除"""
-    if user_id not in user_sent_messages:
-        user_sent_messages[user_id] = []
-    user_sent_messages[user_id].append(message.message_id)
+    message_tracker.add(user_id, [message.message_id])
     return message
 
 async def track_user_message(update):
     """跟踪用户发送的消息，用于后续删除"""
     if not update.message:
         return
-    user_id = update.effective_user.id
-    if user_id not in user_command_messages:
-        user_command_messages[user_id] = []
-    user_command_messages[user_id].append(update.message.message_id)
+    message_tracker.add(update.effective_user.id, [update.message.message_id])
 
 async def should_respond_in_group(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """检查在群聊中是否应该响应消息"""
@@ -180,76 +627,968 @@ def build_link(entity, message_id):
         original_channel_id = str(abs(entity + 1000000000000))
         return f"https://t.me/c/{original_channel_id}/{message_id}"
 
-async def send_message_to_user(entity, message_id, user_id, add_link=True):
-    """发送单个消息给用户"""
+# ==================== 自适应限流器 ====================
+
+FLOOD_ERRORS = (errors.FloodWaitError, errors.SlowModeWaitError, errors.FloodPremiumWaitError)
+RATE_LIMIT_MIN = 0.05  # 最低速率（次/秒）
+RATE_LIMIT_MAX = 2.0  # 默认最高速率（次/秒），可在 config.json 中用 rate_limit_max 修改
+RATE_DECREASE = 0.5  # 遇到限流时速率乘以该系数
+RATE_INCREASE = 1.05  # 冷却期过后每次成功调用速率乘以该系数
+RATE_COOLDOWN = 60  # 最近一次限流后多少秒内不提速
+
+class TokenBucket:
+    """单个 (账号, 会话) 的令牌桶"""
+
+    def __init__(self, rate: float, max_rate: float):
+        self.rate = rate
+        self.max_rate = max_rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.last_flood = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> float:
+        """取得一个令牌，返回等待的秒数"""
+        waited = 0.0
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    delay = self.blocked_until - now
+                else:
+                    self.tokens = min(1.0, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1.0:
+                        self.tokens -= 1.0
+                        return waited
+                    delay = (1.0 - self.tokens) / self.rate
+                await asyncio.sleep(delay)
+                waited += delay
+
+    def ready_in(self) -> float:
+        """距离下一个令牌可用还需等待的秒数（不消耗令牌）"""
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        tokens = min(1.0, self.tokens + (now - self.updated) * self.rate)
+        return 0.0 if tokens >= 1.0 else (1.0 - tokens) / self.rate
+
+    def on_success(self) -> None:
+        if time.monotonic() - self.last_flood > RATE_COOLDOWN and self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate * RATE_INCREASE)
+
+    def on_flood(self, seconds: float) -> None:
+        now = time.monotonic()
+        self.last_flood = now
+        self.rate = max(RATE_LIMIT_MIN, self.rate * RATE_DECREASE)
+        self.blocked_until = max(self.blocked_until, now + seconds + 1)
+        # 封禁期间不积累令牌
+        self.tokens = 0.0
+        self.updated = self.blocked_until
+
+class RateLimiter:
+    """所有 Telegram 调用共用的限流器：每个 (账号, 会话) 一个令牌桶，
+    遇到 FloodWait/SlowModeWait 降速并等待，之后逐步恢复"""
+
+    def __init__(self):
+        self.buckets = {}
+        self.base_rate = 1.0
+        self.max_rate = RATE_LIMIT_MAX
+        self.total_wait = 0.0
+        self.flood_count = 0
+
+    def configure(self, config: dict) -> None:
+        """按 delay_seconds 设置初始速率；已有令牌桶只在初始速率改变时重置，否则保留限流后的速率，只受新上限约束"""
+        delay = float(config.get('delay_seconds', 1.0) or 0)
+        self.max_rate = float(config.get('rate_limit_max', RATE_LIMIT_MAX))
+        base_rate = min(self.max_rate, 1.0 / delay) if delay > 0 else self.max_rate
+        reset = base_rate != self.base_rate
+        self.base_rate = base_rate
+        for bucket in self.buckets.values():
+            bucket.max_rate = self.max_rate
+            bucket.rate = self.base_rate if reset else min(bucket.rate, self.max_rate)
+
+    def bucket(self, key) -> TokenBucket:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.base_rate, self.max_rate)
+        return bucket
+
+    def current_rate(self, key) -> float:
+        bucket = self.buckets.get(key)
+        return bucket.rate if bucket else self.base_rate
+
+    async def call(self, key, func, *args, max_retries: int = 3, on_flood=None, **kwargs):
+        """限流后调用 func，遇到限流自动等待并重试，超过重试次数后抛出最后一次的限流错误"""
+        bucket = self.bucket(key)
+        for attempt in range(max_retries + 1):
+            self.total_wait += await bucket.acquire()
+            try:
+                result = await func(*args, **kwargs)
+            except FLOOD_ERRORS as e:
+                seconds = getattr(e, 'seconds', 0) or 0
+                self.flood_count += 1
+                bucket.on_flood(seconds)
+                if attempt >= max_retries:
+                    logger.warning(f"{key} 遇到限流，需等待 {seconds} 秒，速率降至 {bucket.rate:.2f} 次/秒")
+                    raise
+                logger.warning(f"{key} 遇到限流，等待 {seconds} 秒，速率降至 {bucket.rate:.2f} 次/秒 "
+                               f"(第 {attempt + 1}/{max_retries} 次重试)")
+                if on_flood:
+                    await on_flood(seconds)
+                continue
+            bucket.on_success()
+            return result
+
+    def summary(self) -> str:
+        lines = [f"累计限流等待 {self.total_wait:.0f} 秒，触发限流 {self.flood_count} 次"]
+        for (account, peer), bucket in self.buckets.items():
+            lines.append(f"{account} -> {peer}: {bucket.rate:.2f} 次/秒")
+        return '\n'.join(lines)
+
+rate_limiter = RateLimiter()
+
+def client_label(tg_client) -> str:
+    """账号标识，用作限流 key 的一部分"""
+    filename = getattr(tg_client.session, 'filename', None)
+    if filename:
+        return os.path.basename(str(filename)).replace('.session', '')
+    return str(id(tg_client))
+
+async def limited_call(tg_client, peer, func, *args, **kwargs):
+    """通过共享限流器调用 tg_client 的方法，peer 为目标会话"""
+    return await rate_limiter.call((client_label(tg_client), str(peer)), func, *args, **kwargs)
+
+# ==================== 会话解析缓存 ====================
+# 用户名、频道链接、-100 开头的 id 解析为 InputPeer 后保存到文件，重启后继续使用。
+# access_hash 因账号而异，每个账号分别缓存；一次克隆任务中每个会话只解析一次，
+# 避免频繁调用限流最严格的 ResolveUsername
+
+ENTITY_CACHE_FILE = os.path.join(LINKS_DIR, 'entity_cache.json')
+ENTITY_CACHE_TTL = 7 * 24 * 3600  # 解析结果有效期（秒）
+
+class EntityResolver:
+    """持久化的会话解析缓存"""
+
+    def __init__(self, path: str = ENTITY_CACHE_FILE, ttl: float = ENTITY_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.data = {}  # 账号 -> {会话: {'type', 'id', 'hash', 'time'}}
+        self.resolved = 0  # 实际发出的解析请求数
+        if os.path.isfile(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.data = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"读取会话解析缓存失败: {e}")
+
+    @staticmethod
+    def normalize(chat) -> str:
+        if isinstance(chat, str):
+            chat = parse_channel_input(chat.strip())
+        return str(chat).lower()
+
+    def save(self) -> None:
+        tmp_file = self.path + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f)
+        os.replace(tmp_file, self.path)
+
+    @staticmethod
+    def to_dict(peer) -> dict:
+        from telethon.tl.types import InputPeerChannel, InputPeerChat, InputPeerUser
+
+        if isinstance(peer, InputPeerChannel):
+            return {'type': 'channel', 'id': peer.channel_id, 'hash': peer.access_hash}
+        if isinstance(peer, InputPeerUser):
+            return {'type': 'user', 'id': peer.user_id, 'hash': peer.access_hash}
+        if isinstance(peer, InputPeerChat):
+            return {'type': 'chat', 'id': peer.chat_id}
+        return None
+
+    @staticmethod
+    def from_dict(item: dict):
+        from telethon.tl.types import InputPeerChannel, InputPeerChat, InputPeerUser
+
+        if item['type'] == 'channel':
+            return InputPeerChannel(item['id'], item['hash'])
+        if item['type'] == 'user':
+            return InputPeerUser(item['id'], item['hash'])
+        return InputPeerChat(item['id'])
+
+    async def resolve(self, tg_client, chat):
+        """返回 chat 在 tg_client 账号下的 InputPeer；已是 Telethon 对象的原样返回"""
+        if not isinstance(chat, (str, int)):
+            return chat
+        account = client_label(tg_client)
+        key = self.normalize(chat)
+        item = self.data.get(account, {}).get(key)
+        if item and time.time() - item['time'] < self.ttl:
+            return self.from_dict(item)
+        value = parse_channel_input(chat.strip()) if isinstance(chat, str) else chat
+        peer = await limited_call(tg_client, key, tg_client.get_input_entity, value)
+        self.resolved += 1
+        item = self.to_dict(peer)
+        if item:
+            item['time'] = time.time()
+            self.data.setdefault(account, {})[key] = item
+            self.save()
+        return peer
+
+    def invalidate(self, tg_client, chat) -> None:
+        if isinstance(chat, (str, int)):
+            self.data.get(client_label(tg_client), {}).pop(self.normalize(chat), None)
+
+entity_resolver = EntityResolver()
+
+# 无法访问会话时的错误，缓存的解析结果可能已失效
+PEER_ERRORS = (errors.ChannelInvalidError, errors.ChannelPrivateError, errors.PeerIdInvalidError)
+
+# ==================== 多账号发送池 ====================
+
+class SenderAccount:
+    """发送池中的一个账号及其统计"""
+
+    def __init__(self, name: str, tg_client, is_bot: bool = False):
+        self.name = name
+        self.client = tg_client
+        self.is_bot = is_bot  # 机器人账号不能读取频道历史，收集索引时只用用户账号
+        self.sent = 0
+        self.failed = 0
+        self.floods = 0
+        self.blocked_until = 0.0
+        self.started = time.monotonic()
+
+    def on_flood(self, seconds: float) -> None:
+        self.floods += 1
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds + 1)
+
+    def status(self) -> str:
+        elapsed = max(1.0, time.monotonic() - self.started)
+        blocked = self.blocked_until - time.monotonic()
+        health = f"限流中，剩余 {blocked:.0f} 秒" if blocked > 0 else "正常"
+        return (f"{self.name}: {health} | 已发送 {self.sent} | 失败 {self.failed} | "
+                f"限流 {self.floods} 次 | {self.sent * 60 / elapsed:.1f} 条/分钟")
+
+class SenderPool:
+    """多个账号轮流发送克隆消息。每次选择最早可发送的账号，同一目标的帖子依次发送以保证顺序；
+    遇到 FloodWait 的账号在等待期内不再被选中"""
+
+    def __init__(self, primary_client):
+        self.primary = SenderAccount(client_label(primary_client), primary_client, is_bot=True)
+        self.accounts = [self.primary]
+
+    def add(self, name: str, tg_client, is_bot: bool = False) -> None:
+        self.accounts.append(SenderAccount(name, tg_client, is_bot))
+
+    def pick(self, peer, only_primary: bool = False, sender: str = None) -> SenderAccount:
+        if sender:
+            # 修改和删除消息只能由发出该消息的账号进行
+            return next((account for account in self.accounts if account.name == sender), self.primary)
+        now = time.monotonic()
+
+        def ready_at(account):
+            bucket = rate_limiter.bucket((account.name, str(peer)))
+            return max(account.blocked_until, now + bucket.ready_in())
+
+        return min([self.primary] if only_primary else self.accounts, key=ready_at)
+
+    async def call(self, peer, method: str, *args, on_flood=None, only_primary: bool = False,
+                   sender: str = None, **kwargs):
+        """选择账号调用 TelegramClient 的 method，返回调用结果；所有账号都在限流时等待最早恢复的账号
+
+        only_primary=True 时只用主账号（例如媒体由主账号上传，其他账号无法引用）；
+        sender 为账号名时只用该账号（例如修改或删除该账号发出的消息）
+        """
+        last_error = None
+        for attempt in range(len(self.accounts) + 3):
+            account = self.pick(peer, only_primary, sender)
+            wait = account.blocked_until - time.monotonic()
+            if wait > 0 and on_flood:
+                await on_flood(int(wait) + 1)
+            try:
+                call_args, call_kwargs = await self.resolve_args(account, peer, args, kwargs)
+                result = await rate_limiter.call((account.name, str(peer)), getattr(account.client, method),
+                                                  *call_args, max_retries=0, **call_kwargs)
+            except FLOOD_ERRORS as e:
+                account.on_flood(getattr(e, 'seconds', 0) or 0)
+                last_error = e
+                continue
+            except (errors.RPCError, ValueError) as e:
+                account.failed += 1
+                if isinstance(e, PEER_ERRORS):
+                    entity_resolver.invalidate(account.client, peer)
+                if account is self.primary:
+                    raise
+                # 其他账号可能没有目标频道的权限或无法访问该媒体，交给主账号发送
+                logger.warning(f"账号 {account.name} 发送失败: {e}，改用主账号")
+                call_args, call_kwargs = await self.resolve_args(self.primary, peer, args, kwargs)
+                result = await rate_limiter.call((self.primary.name, str(peer)), getattr(self.primary.client, method),
+                                                  *call_args, on_flood=on_flood, **call_kwargs)
+                account = self.primary
+            account.sent += 1
+            return result
+        raise last_error
+
+    def account_of(self, msg) -> str:
+        """发出该消息的账号名"""
+        tg_client = getattr(msg, '_client', None)
+        return next((account.name for account in self.accounts if account.client is tg_client), self.primary.name)
+
+    @staticmethod
+    async def resolve_args(account: SenderAccount, peer, args: tuple, kwargs: dict):
+        """把参数中的目标会话和 from_peer 替换为该账号缓存的 InputPeer"""
+        if args and args[0] is peer:
+            args = (await entity_resolver.resolve(account.client, peer),) + tuple(args[1:])
+        if kwargs.get('from_peer') is not None:
+            kwargs = dict(kwargs, from_peer=await entity_resolver.resolve(account.client, kwargs['from_peer']))
+        return args, kwargs
+
+    def summary(self) -> str:
+        return '\n'.join(account.status() for account in self.accounts)
+
+sender_pool = SenderPool(client)
+
+async def start_sender_pool(config: dict) -> None:
+    """启动 config.json 中 sender_sessions 配置的额外发送账号
+
+    每项可以是会话名（已登录的用户会话），或 {"session": 会话名, "bot_token": 机器人令牌}
+    """
+    for item in config.get('sender_sessions') or []:
+        if isinstance(item, str):
+            item = {'session': item}
+        name = item.get('session')
+        if not name or any(account.name == name for account in sender_pool.accounts):
+            continue
+        extra_client = TelegramClient(name, API_ID, API_HASH)
+        extra_client.flood_sleep_threshold = 0
+        try:
+            if item.get('bot_token'):
+                await extra_client.start(bot_token=item['bot_token'])
+            else:
+                await extra_client.connect()
+                if not await extra_client.is_user_authorized():
+                    print(f"⚠️  发送账号 {name} 未登录，已跳过")
+                    await extra_client.disconnect()
+                    continue
+            sender_pool.add(name, extra_client, is_bot=bool(item.get('bot_token')))
+            print(f"✅ 发送账号 {name} 已加入发送池")
+        except Exception as e:
+            print(f"⚠️  发送账号 {name} 启动失败: {e}")
+
+# ==================== 消息缓存 ====================
+
+MESSAGE_CACHE_SIZE = 5000  # 最多缓存的消息条数
+MESSAGE_CACHE_TTL = 600  # 缓存有效期（秒），避免长期使用编辑前的旧消息
+PREFETCH_CHUNK = 100  # 顺序读取时每次向后预取的 id 数量（GetMessages 单次上限）
+
+class MessageCache:
+    """按 (entity, message_id) 缓存已获取的消息，LRU 淘汰；不存在的 id 也缓存为 None"""
+
+    def __init__(self, capacity: int = MESSAGE_CACHE_SIZE, ttl: float = MESSAGE_CACHE_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.requests = 0  # 实际发出的 GetMessages 请求数
+
+    def _lookup(self, key):
+        item = self.data.get(key)
+        if item is None:
+            return False, None
+        stored_at, msg = item
+        if time.monotonic() - stored_at > self.ttl:
+            del self.data[key]
+            return False, None
+        self.data.move_to_end(key)
+        return True, msg
+
+    def put(self, entity, message_id: int, msg) -> None:
+        key = (entity, message_id)
+        self.data[key] = (time.monotonic(), msg)
+        self.data.move_to_end(key)
+        while len(self.data) > self.capacity:
+            self.data.popitem(last=False)
+
+    def invalidate(self, entity, message_id: int) -> None:
+        self.data.pop((entity, message_id), None)
+
+    def contains(self, entity, ids: list) -> bool:
+        """ids 是否全部在缓存中且未过期"""
+        return all(self._lookup((entity, mid))[0] for mid in ids)
+
+    async def get_messages(self, tg_client, entity, ids: list, prefetch: int = 0, extra_ids: list = None) -> list:
+        """按 ids 顺序返回消息（不存在为 None）；缺失部分合并请求，
+        prefetch>0 时顺带预取后续 id，extra_ids 为已知即将用到的 id，在同一请求中补满"""
+        found = {}
+        missing = []
+        for mid in ids:
+            hit, msg = self._lookup((entity, mid))
+            if hit:
+                found[mid] = msg
+            else:
+                missing.append(mid)
+        if missing:
+            fetch_ids = missing
+            missing_set = set(missing)
+            if prefetch:
+                # 从第一个缺失的 id 开始向后整块预取，跳过已缓存的 id
+                start = min(missing)
+                end = max(max(missing) + 1, start + prefetch)
+                fetch_ids = [mid for mid in range(start, end)
+                             if mid in missing_set or (entity, mid) not in self.data]
+            elif extra_ids:
+                room = PREFETCH_CHUNK - len(missing) % PREFETCH_CHUNK
+                extra = [mid for mid in extra_ids if mid not in missing_set and (entity, mid) not in self.data]
+                fetch_ids = missing + extra[:room]
+            for i in range(0, len(fetch_ids), PREFETCH_CHUNK):
+                chunk = fetch_ids[i:i + PREFETCH_CHUNK]
+                peer = await entity_resolver.resolve(tg_client, entity)
+                messages = await limited_call(tg_client, entity, tg_client.get_messages, peer, ids=chunk)
+                self.requests += 1
+                # 超过本次返回的最大 id 的空位可能是尚未发布的消息，不缓存为不存在
+                highest = max((msg.id for msg in messages if msg), default=0)
+                for mid, msg in zip(chunk, messages):
+                    if msg is not None or mid < highest:
+                        self.put(entity, mid, msg)
+                    if mid in missing_set:
+                        found[mid] = msg
+        return [found.get(mid) for mid in ids]
+
+message_cache = MessageCache()
+
+async def fetch_message_group(entity, message_id: int, member_ids: list = None, prefetch_ids: list = None):
+    """获取目标消息及其同组（媒体组）消息，按 id 排序；目标消息不存在返回 None
+
+    已知组内成员（来自频道索引）时只请求这些 id，prefetch_ids 为后续帖子的成员，合并在同一请求中预取
+    """
+    if member_ids:
+        messages = await message_cache.get_messages(client, entity, member_ids, extra_ids=prefetch_ids)
+        valid_messages = sorted((msg for msg in messages if msg), key=lambda x: x.id)
+        return valid_messages or None
+    # 获取消息组, 前后10条
+    start_id = max(1, message_id - 10)
+    message_ids = list(range(start_id, message_id + 10))
+    messages = await message_cache.get_messages(client, entity, message_ids, prefetch=PREFETCH_CHUNK)
+    target_msg = next((msg for msg in messages if msg and msg.id == message_id), None)
+    if not target_msg:
+        return None
+    # 获取同组消息
+    if target_msg.grouped_id:
+        valid_messages = [msg for msg in messages if msg and msg.grouped_id == target_msg.grouped_id]
+    else:
+        valid_messages = [target_msg]
+    valid_messages.sort(key=lambda x: x.id)
+    return valid_messages
+
+# ==================== 媒体引用缓存 ====================
+# 禁止转发的源媒体 (类型, id, access_hash) -> 主账号第一次中转上传后发出的副本（InputMedia）。
+# 同一媒体发给多个频道时直接引用这份副本，不再重复下载上传。
+# file reference 会过期，缓存设有效期，发送时提示过期则立即失效
+
+MEDIA_CACHE_SIZE = 2000  # 最多缓存的媒体数
+MEDIA_CACHE_TTL = 3600  # 缓存有效期（秒）
+
+class MediaCache:
+    """中转媒体副本缓存，LRU 淘汰"""
+
+    def __init__(self, capacity: int = MEDIA_CACHE_SIZE, ttl: float = MEDIA_CACHE_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = 0
+
+    @staticmethod
+    def key(media):
+        photo = getattr(media, 'photo', None)
+        if photo and hasattr(photo, 'access_hash'):
+            return ('photo', photo.id, photo.access_hash)
+        document = getattr(media, 'document', None)
+        if document and hasattr(document, 'access_hash'):
+            return ('document', document.id, document.access_hash)
+        return None
+
+    def get(self, media):
+        key = self.key(media)
+        item = self.data.get(key) if key else None
+        if item is None:
+            return None
+        stored_at, input_media = item
+        if time.monotonic() - stored_at > self.ttl:
+            del self.data[key]
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return input_media
+
+    def put(self, media, input_media) -> None:
+        key = self.key(media)
+        if not key:
+            return
+        self.data[key] = (time.monotonic(), input_media)
+        self.data.move_to_end(key)
+        while len(self.data) > self.capacity:
+            self.data.popitem(last=False)
+
+    def invalidate(self, media_list: list) -> None:
+        for media in media_list:
+            key = self.key(media)
+            if key:
+                self.data.pop(key, None)
+
+media_cache = MediaCache()
+
+# ==================== 源→目标消息映射 ====================
+# 记录每个克隆出的帖子在目标频道中的消息 id，源消息被编辑或删除时据此同步到目标频道。
+# posts 表每个 (源频道, 帖子首条 id, 目标频道) 一行，pairs 为发送顺序的 [源消息 id, 目标消息 id]，
+# 超出 caption 长度单独发送的文本对应源 id 0，sender 为发出帖子的账号；members 表把帖子内每条源消息映射到帖子首条 id。
+# 两张表都以主键 B 树索引，按 (源频道, 消息 id) 查询为 O(log n)
+
+MESSAGE_MAP_FILE = os.path.join(LINKS_DIR, 'message_map.db')
+
+# 频道输入（用户名、链接、数字 id）-> 带标记的 peer id
+peer_id_cache = {}
+
+async def get_peer_id(entity) -> int:
+    from telethon import utils
+
+    key = str(entity)
+    if key not in peer_id_cache:
+        value = parse_channel_input(entity) if isinstance(entity, str) else entity
+        # 数字 id 本身就是 peer id，无需解析
+        peer_id_cache[key] = value if isinstance(value, int) else utils.get_peer_id(
+            await entity_resolver.resolve(client, entity))
+    return peer_id_cache[key]
+
+class MessageMap:
+    """源消息到目标消息的持久化映射（SQLite）"""
+
+    def __init__(self, path: str = MESSAGE_MAP_FILE):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS posts (src_chat INTEGER, post_id INTEGER, dst_chat INTEGER, '
+                          'pairs TEXT, members TEXT, sender TEXT, PRIMARY KEY (src_chat, post_id, dst_chat)) WITHOUT ROWID')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS members (src_chat INTEGER, src_id INTEGER, post_id INTEGER, '
+                          'PRIMARY KEY (src_chat, src_id)) WITHOUT ROWID')
+        self.conn.commit()
+
+    def save(self, src_chat: int, post_id: int, dst_chat: int, pairs: list, members: list,
+             sender: str = None) -> None:
+        self.conn.execute('INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?, ?, ?)',
+                          (src_chat, post_id, dst_chat, json.dumps(pairs), json.dumps(members), sender))
+        self.conn.executemany('INSERT OR REPLACE INTO members VALUES (?, ?, ?)',
+                              [(src_chat, src_id, post_id) for src_id in members])
+        self.conn.commit()
+
+    async def record(self, entity, post, channel_entity, sent_ids: list) -> None:
+        """记录一个已发送的帖子；映射失败只记录日志，不影响克隆"""
+        if not sent_ids or not post.source_ids:
+            return
+        try:
+            src_chat = await get_peer_id(entity)
+            dst_chat = await get_peer_id(channel_entity)
+        except Exception as e:
+            logger.warning(f"无法记录消息映射 {entity} -> {channel_entity}: {e}")
+            return
+        # 媒体与发出的消息一一对应，其余为文本消息；纯文本帖子的文本对应首条源消息
+        src_ids = post.media_ids if post.media_list else post.source_ids[:1]
+        pairs = [[src_id, dst_id] for src_id, dst_id in zip(src_ids, sent_ids)]
+        pairs += [[0, dst_id] for dst_id in sent_ids[len(pairs):]]
+        try:
+            self.save(src_chat, post.source_ids[0], dst_chat, pairs, post.source_ids, post.sender)
+        except sqlite3.Error as e:
+            logger.warning(f"无法记录消息映射 {entity} -> {channel_entity}: {e}")
+
+    def lookup(self, src_chat: int, src_id: int) -> list:
+        """返回包含该源消息的帖子在各目标频道中的记录 [(post_id, dst_chat, pairs, members, sender)]"""
+        row = self.conn.execute('SELECT post_id FROM members WHERE src_chat = ? AND src_id = ?',
+                                (src_chat, src_id)).fetchone()
+        if not row:
+            return []
+        return [(row[0], dst_chat, json.loads(pairs), json.loads(members), sender)
+                for dst_chat, pairs, members, sender in self.conn.execute(
+                    'SELECT dst_chat, pairs, members, sender FROM posts WHERE src_chat = ? AND post_id = ?',
+                    (src_chat, row[0]))]
+
+    def remove_members(self, src_chat: int, src_ids: list) -> None:
+        self.conn.executemany('DELETE FROM members WHERE src_chat = ? AND src_id = ?',
+                              [(src_chat, src_id) for src_id in src_ids])
+        self.conn.commit()
+
+    def remove_post(self, src_chat: int, post_id: int, dst_chat: int) -> None:
+        self.conn.execute('DELETE FROM posts WHERE src_chat = ? AND post_id = ? AND dst_chat = ?',
+                          (src_chat, post_id, dst_chat))
+        self.conn.commit()
+
+message_map = MessageMap()
+
+# ==================== 目标频道去重索引 ====================
+# 帖子指纹 = 媒体的 photo/document id + 规范化文本的哈希。发送前检查目标频道是否已有相同指纹，
+# 避免重复克隆或多个互相转载的源频道产生重复帖子。目标频道已有的历史可扫描一次加入索引
+
+def media_key(media) -> str:
+    photo = getattr(media, 'photo', None)
+    if photo:
+        return f"p{photo.id}"
+    document = getattr(media, 'document', None)
+    if document:
+        return f"d{document.id}"
+    return type(media).__name__
+
+def post_fingerprint(media_list: list, text: str) -> str:
+    normalized = ' '.join((text or '').split())
+    content = ','.join(media_key(media) for media in media_list) + '\n' + normalized
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+class DedupIndex:
+    """每个目标频道已有帖子的指纹（SQLite，与消息映射同一个数据库文件）"""
+
+    def __init__(self, path: str = MESSAGE_MAP_FILE):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS fingerprints (dst_chat INTEGER, fingerprint TEXT, dst_id INTEGER, '
+                          'PRIMARY KEY (dst_chat, fingerprint)) WITHOUT ROWID')
+        # 每个目标频道历史已扫描到的消息 id
+        self.conn.execute('CREATE TABLE IF NOT EXISTS seeded (dst_chat INTEGER PRIMARY KEY, max_id INTEGER)')
+        self.conn.commit()
+
+    def contains(self, dst_chat: int, fingerprint: str) -> bool:
+        return self.conn.execute('SELECT 1 FROM fingerprints WHERE dst_chat = ? AND fingerprint = ?',
+                                 (dst_chat, fingerprint)).fetchone() is not None
+
+    def add(self, dst_chat: int, fingerprint: str, dst_id: int) -> None:
+        self.conn.execute('INSERT OR IGNORE INTO fingerprints VALUES (?, ?, ?)', (dst_chat, fingerprint, dst_id))
+        self.conn.commit()
+
+    def add_seeded(self, dst_chat: int, rows: list, max_id: int) -> None:
+        """批量加入扫描得到的 [(指纹, 消息 id)]，并记录扫描进度"""
+        self.conn.executemany('INSERT OR IGNORE INTO fingerprints VALUES (?, ?, ?)',
+                              [(dst_chat, fingerprint, dst_id) for fingerprint, dst_id in rows])
+        self.conn.execute('INSERT OR REPLACE INTO seeded VALUES (?, ?)', (dst_chat, max_id))
+        self.conn.commit()
+
+    def seeded_id(self, dst_chat: int) -> int:
+        row = self.conn.execute('SELECT max_id FROM seeded WHERE dst_chat = ?', (dst_chat,)).fetchone()
+        return row[0] if row else 0
+
+dedup_index = DedupIndex()
+
+# ==================== 受保护频道媒体中转 ====================
+# 禁止转发的频道不能直接引用原媒体发送，需要下载后重新上传。
+# 大文件按块分成 download_parallel 段并行下载，直接写入临时文件对应位置，不在内存中保存整个文件；
+# 上传时 Telethon 从临时文件分块读取。临时文件总大小受磁盘预算限制，上传后立即删除（debug_keep_downloads 时保留）
+
+DOWNLOAD_DIR = 'downloads'
+DOWNLOAD_CHUNK_SIZE = 512 * 1024  # 单次 GetFile 请求的最大字节数
+DOWNLOAD_PARALLEL_MIN_SIZE = 8 * 1024 * 1024  # 小于该大小的文件不分段
+DOWNLOAD_FLOOD_RETRIES = 3  # 分段下载遇到限流时每段最多重试的次数
+DOWNLOAD_DISK_BUDGET_MB = 2048  # 临时文件占用的磁盘上限，可在 config.json 中用 download_disk_budget_mb 修改
+
+class DiskBudget:
+    """限制同时存在的临时文件总大小，超出预算时等待其他文件上传完成后释放"""
+
+    def __init__(self):
+        self.used = 0
+        self.condition = asyncio.Condition()
+
+    def limit(self) -> int:
+        return int(float(dynamic_config.get('download_disk_budget_mb', DOWNLOAD_DISK_BUDGET_MB)) * 1024 * 1024)
+
+    async def acquire(self, size: int) -> None:
+        if size > self.limit():
+            raise RuntimeError(f"文件大小 {size // 1048576} MB 超过磁盘预算 {self.limit() // 1048576} MB")
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.used + size <= self.limit())
+            self.used += size
+
+    async def release(self, size: int) -> None:
+        async with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+disk_budget = DiskBudget()
+
+async def download_parallel(tg_client, media, size: int, path: str) -> None:
+    """把文件按块分成若干段，每段一个 iter_download 并行下载并写入临时文件的对应位置"""
+    parts = max(1, int(dynamic_config.get('download_parallel', 4)))
+    chunk_count = (size + DOWNLOAD_CHUNK_SIZE - 1) // DOWNLOAD_CHUNK_SIZE
+    bounds = [chunk_count * k // parts for k in range(parts + 1)]
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+    async def download_range(first: int, count: int) -> None:
+        # 客户端不会自动等待限流，遇到限流时等待后从已下载的位置继续
+        done = 0
+        retries = 0
+        with open(path, 'r+b') as f:
+            while done < count:
+                f.seek((first + done) * DOWNLOAD_CHUNK_SIZE)
+                try:
+                    async for chunk in tg_client.iter_download(media, offset=(first + done) * DOWNLOAD_CHUNK_SIZE,
+                                                              limit=count - done, request_size=DOWNLOAD_CHUNK_SIZE,
+                                                              file_size=size):
+                        f.write(chunk)
+                        done += 1
+                except FLOOD_ERRORS as e:
+                    retries += 1
+                    seconds = getattr(e, 'seconds', 0) or 1
+                    if retries > DOWNLOAD_FLOOD_RETRIES:
+                        raise
+                    rate_limiter.flood_count += 1
+                    rate_limiter.total_wait += seconds
+                    logger.warning(f"分段下载遇到限流，等待 {seconds} 秒后继续 (第 {retries}/{DOWNLOAD_FLOOD_RETRIES} 次重试)")
+                    await asyncio.sleep(seconds)
+
+    await asyncio.gather(*(download_range(bounds[k], bounds[k + 1] - bounds[k])
+                           for k in range(parts) if bounds[k + 1] > bounds[k]))
+
+async def transfer_media(tg_client, media):
+    """下载一个媒体并由 tg_client 重新上传，返回可直接发送的 InputMedia；不支持的媒体原样返回"""
+    from telethon import utils
+    from telethon.tl.types import InputMediaUploadedPhoto, InputMediaUploadedDocument
+
+    photo = getattr(media, 'photo', None)
+    document = getattr(media, 'document', None)
+    if photo:
+        size = max((getattr(s, 'size', 0) or max(getattr(s, 'sizes', None) or [0]) for s in photo.sizes), default=0)
+        prefix, suffix = f"photo_{photo.id}_", '.jpg'
+    elif document:
+        size = document.size
+        prefix, suffix = f"document_{document.id}_", utils.get_extension(media)
+    else:
+        return media
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    size = max(size, DOWNLOAD_CHUNK_SIZE)
+    await disk_budget.acquire(size)
+    temp_path = path = None
     try:
-        # 获取消息组, 前后10条
-        message_ids = list(range(message_id - 10, message_id + 10))
-        messages = await client.get_messages(entity, ids=message_ids)
-        
-        # 找到目标消息和同组消息
-        target_msg = next((msg for msg in messages if msg and msg.id == message_id), None)
-        if not target_msg:
-            return False
-        
-        # 获取同组消息
-        if target_msg.grouped_id:
-            valid_messages = [msg for msg in messages if msg and msg.grouped_id == target_msg.grouped_id]
+        # 同一媒体可能同时被多个任务中转，每次使用独立的临时文件
+        fd, temp_path = tempfile.mkstemp(prefix=prefix, suffix=suffix, dir=DOWNLOAD_DIR)
+        os.close(fd)
+        path = temp_path
+        if document and document.size >= DOWNLOAD_PARALLEL_MIN_SIZE:
+            await download_parallel(tg_client, media, document.size, path)
         else:
-            valid_messages = [target_msg]
+            # download_media 会按 mime 类型补上扩展名，以返回的实际路径为准
+            path = await limited_call(tg_client, 'files', tg_client.download_media, media, file=path) or path
+        # 上传和下载经过共享限流器，遇到限流时等待后重试
+        input_file = await limited_call(tg_client, 'files', tg_client.upload_file, path)
+    finally:
+        if not dynamic_config.get('debug_keep_downloads'):
+            for leftover in {temp_path, path}:
+                if leftover and os.path.exists(leftover):
+                    os.remove(leftover)
+        await disk_budget.release(size)
+    if photo:
+        return InputMediaUploadedPhoto(file=input_file)
+    return InputMediaUploadedDocument(file=input_file, mime_type=document.mime_type or 'application/octet-stream',
+                                      attributes=document.attributes)
+
+async def transfer_post_media(post) -> None:
+    """把帖子的媒体替换为由主账号重新上传的媒体，之后只能由主账号发送
+
+    主账号已经上传过的媒体（媒体缓存中有副本）直接引用，不再下载
+    """
+    if post.transferred:
+        return
+    started = time.monotonic()
+    media_list = []
+    transferred = 0
+    for media in post.source_media:
+        cached = media_cache.get(media)
+        if cached is None:
+            cached = await transfer_media(client, media)
+            transferred += 1
+        media_list.append(cached)
+    post.media_list = media_list
+    post.transferred = True
+    if transferred:
+        logger.info(f"已中转 {transferred} 个媒体，耗时 {time.monotonic() - started:.1f} 秒")
+
+def remember_uploaded_media(post, sent_messages: list) -> None:
+    """记录中转后发送成功的媒体，之后发给其他目标时直接引用主账号的这份副本"""
+    from telethon import utils
+
+    for media, msg in zip(post.source_media, sent_messages):
+        if msg and msg.media:
+            try:
+                media_cache.put(media, utils.get_input_media(msg.media))
+            except TypeError:
+                pass
+
+async def refresh_post_media(post) -> bool:
+    """file reference 过期时重新获取源消息，替换帖子中的媒体；无法获取时返回 False"""
+    media_cache.invalidate(post.source_media)
+    if post.refreshed or post.source_peer is None or not post.media_ids:
+        return False
+    post.refreshed = True
+    fresh = await limited_call(client, post.source_peer, client.get_messages, post.source_peer, ids=post.media_ids)
+    media_list = [msg.media for msg in fresh if msg and msg.media]
+    if len(media_list) != len(post.source_media):
+        return False
+    post.media_list = post.source_media = media_list
+    post.transferred = False
+    return True
+
+async def target_chat_id(channel_entity):
+    """目标频道的 peer id，无法解析时返回 None（此时不做去重）"""
+    try:
+        return await get_peer_id(channel_entity)
+    except Exception as e:
+        logger.warning(f"无法解析目标频道 {channel_entity}，本次不做去重: {e}")
+        return None
+
+async def seed_dedup_index(channel_entity) -> int:
+    """扫描目标频道上次扫描位置之后的历史，把已有帖子的指纹加入去重索引，返回新增的帖子数。
+
+    需要用户客户端（机器人不能读取频道历史）；已扫描过的频道只读取新消息，通常只需一次请求。
+    """
+    from telethon.tl.types import Message
+
+    if not USER_CLIENT_READY:
+        return 0
+    dst_chat = await get_peer_id(channel_entity)
+    max_id = dedup_index.seeded_id(dst_chat)
+    page_interval = float(dynamic_config.get('collect_page_interval', COLLECT_PAGE_INTERVAL))
+    rows = []
+    group = []
+    added = 0
+
+    def flush_group():
+        if group:
+            text = '\n\n'.join(msg.message.strip() for msg in group if msg.message and msg.message.strip())
+            rows.append((post_fingerprint([msg.media for msg in group if msg.media], text), group[0].id))
+            group.clear()
+
+    peer = await entity_resolver.resolve(user_client, channel_entity)
+    async for msg in user_client.iter_messages(peer, reverse=True, min_id=max_id, wait_time=page_interval):
+        if not isinstance(msg, Message):
+            continue
+        if not (group and msg.grouped_id and msg.grouped_id == group[0].grouped_id):
+            flush_group()
+            if len(rows) >= INDEX_WRITE_BATCH:
+                dedup_index.add_seeded(dst_chat, rows, max_id)
+                added += len(rows)
+                rows = []
+        group.append(msg)
+        max_id = msg.id
+    flush_group()
+    dedup_index.add_seeded(dst_chat, rows, max_id)
+    return added + len(rows)
+
+def render_text(valid_messages: list, rules: TextRules = None):
+    """把一组消息的原始文本用空行连接并应用文本规则，返回 (文本, 实体列表, 是否被规则改写)
+
+    使用 msg.message 和 msg.entities（不含 Markdown 标记），实体随规则一起修正
+    """
+    parts = []
+    spans = []
+    offset = 0
+    for msg in valid_messages:
+        raw = msg.message or ''
+        msg_text = raw.strip()
+        if not msg_text:
+            continue
+        if parts:
+            offset += 2
+        lead = len(raw) - len(raw.lstrip())
+        for start, end, entity in entity_spans(raw, msg.entities):
+            start, end = max(start - lead, 0), min(end - lead, len(msg_text))
+            if end > start:
+                spans.append((offset + start, offset + end, entity))
+        parts.append(msg_text)
+        offset += len(msg_text)
+    if not parts:
+        return '', [], False
+    text, spans, rewritten = (rules or text_rules).transform_spans('\n\n'.join(parts), spans)
+    return text, spans_to_entities(text, spans), rewritten
+
+CAPTION_LIMIT = 1024  # 媒体说明的最大长度（UTF-16 码元）
+MESSAGE_LIMIT = 4096  # 文本消息的最大长度（UTF-16 码元）
+OVERFLOW_PREFIX = '完整内容：\n'  # caption 放不下时，单独发送的剩余文本的开头
+SENTENCE_ENDS = ('。', '！', '？', '；', '! ', '? ', '. ', '; ')
+
+def find_split(text: str, start: int, end: int) -> int:
+    """在 text[start:end] 内找切分位置：优先段落，其次换行、句末、空格，都没有时在 end 处硬切
+
+    切点不早于区间中点，避免切出过短的片段
+    """
+    low = start + (end - start) // 2
+    for sep in ('\n\n', '\n'):
+        pos = text.rfind(sep, low, end)
+        if pos != -1:
+            return pos
+    best = -1
+    for sep in SENTENCE_ENDS:
+        pos = text.rfind(sep, low, end)
+        if pos != -1:
+            best = max(best, pos + len(sep.rstrip()))
+    if best != -1:
+        return best
+    pos = text.rfind(' ', low, end)
+    return pos if pos != -1 else end
+
+def split_text(text: str, entities: list, first_limit: int = MESSAGE_LIMIT, prefix: str = '') -> list:
+    """按 UTF-16 长度把文本切成 [(文本, 实体列表)]，第一段不超过 first_limit，其余每段不超过 4096
+
+    prefix 加在第二段开头并计入长度；跨段的实体被裁成每段各一份，偏移相对所在段
+    """
+    spans = entity_spans(text, entities)
+    index = Utf16Index(text)
+    total = index.to_utf16(len(text))
+    chunks = []
+    start = 0
+    limit = first_limit
+    chunk_prefix = ''
+    while True:
+        budget = limit - utf16_len(chunk_prefix)
+        if total - index.to_utf16(start) <= budget:
+            end = len(text)
+        else:
+            end = find_split(text, start, index.from_utf16(index.to_utf16(start) + budget))
+        chunk = text[start:end].rstrip()
+        shift = len(chunk_prefix) - start
+        chunk_spans = []
+        for span_start, span_end, entity in spans:
+            span_start, span_end = max(span_start, start), min(span_end, start + len(chunk))
+            if span_end > span_start:
+                chunk_spans.append((span_start + shift, span_end + shift, entity))
+        chunk = chunk_prefix + chunk
+        chunks.append((chunk, spans_to_entities(chunk, chunk_spans)))
+        if end >= len(text):
+            return chunks
+        # 下一段跳过切点处的空白
+        start = end
+        while start < len(text) and text[start].isspace():
+            start += 1
+        if start >= len(text):
+            return chunks
+        limit = MESSAGE_LIMIT
+        chunk_prefix = prefix if len(chunks) == 1 else ''
+
+async def send_message_to_user(entity, message_id, user_id, add_link=True, rules=None, member_ids=None):
+    """发送单个消息给用户，已知媒体组成员（来自频道索引）时传入 member_ids"""
+    try:
+        # 获取目标消息和同组消息
+        valid_messages = await fetch_message_group(entity, message_id, member_ids)
+        if not valid_messages:
+            return False
         
-        valid_messages.sort(key=lambda x: x.id)
         sent_message_ids = []
         
         # 收集媒体文件
         media_list = [msg.media for msg in valid_messages if msg.media]
         
-        # 准备文本内容和格式化信息 - 收集所有消息的文本内容
-        text_content = ""
-        formatting_entities = []
-        text_offset = 0
-        
-        for msg in valid_messages:
-            if msg.text and msg.text.strip():
-                msg_text = msg.text.strip()
-                if text_content:
-                    text_content += "\n\n" + msg_text
-                    text_offset += 2  # 添加换行符的长度
-                else:
-                    text_content = msg_text
-                
-                # 收集格式化信息，调整偏移量
-                if msg.entities:
-                    for entity in msg.entities:
-                        # 创建新的实体，调整偏移量
-                        new_entity = entity.__class__(
-                            offset=entity.offset + text_offset,
-                            length=entity.length
-                        )
-                        formatting_entities.append(new_entity)
-                
-                text_offset += len(msg_text)
-        
-        # 应用文本处理规则（在清理 ** 符号之后）
-        if text_content:
-            original_text = text_content
-            text_content = process_text(text_content)
+        # 准备文本内容和格式化信息 - 收集所有消息的文本内容并应用文本处理规则
+        text_content, formatting_entities, _ = render_text(valid_messages, rules)
         #if add_link:
         if media_list:
-            # 发送媒体组
-            caption = text_content[:1024] if len(text_content) > 1024 else text_content
-            
-            # 过滤适合caption长度的格式化信息
-            caption_entities = []
-            if formatting_entities and len(text_content) <= 1024:
-                caption_entities = formatting_entities
-            elif formatting_entities and len(text_content) > 1024:
-                # 只保留在caption范围内的格式化信息
-                for entity in formatting_entities:
-                    if entity.offset < 1024:
-                        caption_entities.append(entity)
-            
-            sent_messages = await client.send_file(
+            # 发送媒体组，caption 放不下的部分单独发送
+            chunks = split_text(text_content, formatting_entities, CAPTION_LIMIT, OVERFLOW_PREFIX)
+            caption, caption_entities = chunks[0]
+            sent_messages = await limited_call(client, user_id, client.send_file,
                 user_id, 
                 file=media_list, 
                 caption=caption,
@@ -261,41 +1600,23 @@ async def send_message_to_user(entity, message_id, user_id, add_link=True):
                 sent_message_ids.extend([msg.id for msg in sent_messages])
             else:
                 sent_message_ids.append(sent_messages.id)
-            
-            # 如果文本太长，单独发送
-            if len(text_content) > 1024:
-                remaining_text = text_content[1024:]
-                remaining_entities = []
-                if formatting_entities:
-                    for entity in formatting_entities:
-                        if entity.offset >= 1024:
-                            # 调整偏移量
-                            new_entity = entity.__class__(
-                                offset=entity.offset - 1024,
-                                length=entity.length
-                            )
-                            remaining_entities.append(new_entity)
-                
-                text_msg = await client.send_message(
-                    user_id, 
-                    f"完整内容：\n{remaining_text}",
-                    formatting_entities=remaining_entities if remaining_entities else None
-                )
-                sent_message_ids.append(text_msg.id)
-        
+            chunks = chunks[1:]
         elif text_content:
-            # 只发送文本
-            text_msg = await client.send_message(
+            # 只发送文本，超过4096的部分分多条发送
+            chunks = split_text(text_content, formatting_entities)
+        else:
+            chunks = []
+        
+        for chunk_text, chunk_entities in chunks:
+            text_msg = await limited_call(client, user_id, client.send_message,
                 user_id, 
-                text_content,
-                formatting_entities=formatting_entities if formatting_entities else None
+                chunk_text,
+                formatting_entities=chunk_entities if chunk_entities else None
             )
             sent_message_ids.append(text_msg.id)
         
         # 记录发送的消息
-        if user_id not in user_sent_messages:
-            user_sent_messages[user_id] = []
-        user_sent_messages[user_id].extend(sent_message_ids)
+        message_tracker.add(user_id, sent_message_ids)
         
         return True
     
@@ -303,162 +1624,244 @@ async def send_message_to_user(entity, message_id, user_id, add_link=True):
         logger.error(f"发送消息失败: {e}")
         return False
 
-def is_ad_media_group(valid_messages: list) -> bool:
-    ad_keywords = dynamic_config['ad_keywords']
-    if not ad_keywords:
-        return False
-    keywords = [k.strip() for k in ad_keywords.split('|') if k.strip()]
+def is_ad_media_group(valid_messages: list, rules: TextRules = None):
+    """检查媒体组是否命中广告/屏蔽关键词，返回命中的关键词，未命中返回 None"""
+    matcher = (rules or text_rules).ad_matcher
+    if not matcher:
+        return None
     for msg in valid_messages:
-        if msg.text:
-            for kw in keywords:
-                if kw in msg.text:
-                    return True
-    return False
+        keyword = matcher.search(msg.text)
+        if keyword:
+            return keyword
+    return None
+
+class RenderedPost:
+    """渲染完成、可直接发送的帖子（文本规则、实体修正和 HTML 备用文本都已处理好）"""
+
+    def __init__(self, media_list: list, text: str, entities: list, extra: list = None,
+                 source_ids: list = None, media_ids: list = None):
+        self.media_list = media_list
+        # 媒体帖子为 caption（最多1024），纯文本帖子为第一段（最多4096）
+        self.text = text
+        self.entities = entities
+        self._html = None
+        # 放不下的剩余文本 [(文本, 实体列表)]，依次单独发送
+        self.extra = extra or []
+        # 源消息 id（按顺序）以及 media_list 中每个媒体对应的源消息 id，用于记录消息映射
+        self.source_ids = source_ids or []
+        self.media_ids = media_ids or []
+        self.fingerprint = post_fingerprint(media_list, text)
+        # 源频道禁止转发时需要下载后重新上传媒体；transferred 表示已替换为主账号上传的媒体
+        self.protected = False
+        self.transferred = False
+        # 源媒体（中转前）及其所在会话，file reference 过期时据此重新获取
+        self.source_media = list(media_list)
+        self.source_peer = None
+        self.refreshed = False
+        # 文本规则是否改变了内容；未改变且源频道允许转发时可以直接用 forward_messages 转发
+        self.rewritten = True
+        # 发出该帖子的发送池账号，剩余文本以及之后的编辑、删除都用同一账号
+        self.sender = None
+
+    @property
+    def html(self) -> str:
+        """实体发送失败时使用的 HTML 备用文本，首次使用时才生成"""
+        if self._html is None:
+            self._html = convert_to_html(self.text, self.entities)
+        return self._html
+
+    @property
+    def forwardable(self) -> bool:
+        return (not self.rewritten and not self.protected and not self.transferred
+                and dynamic_config.get('native_forward', True))
 
-async def send_message_to_channel(entity: Any, message_id: int, channel_entity: Any, add_link: bool = True) -> bool:
+def render_post(valid_messages: list, rules: TextRules = None):
+    """把一组消息渲染为待发送的帖子，没有文本也没有媒体时返回 None"""
+    media_list = [msg.media for msg in valid_messages if msg.media]
+    source_ids = [msg.id for msg in valid_messages]
+    text_content, formatting_entities, rewritten = render_text(valid_messages, rules)
+    if media_list:
+        # 媒体消息的caption限制1024，放不下的部分单独发送
+        chunks = split_text(text_content, formatting_entities, CAPTION_LIMIT, OVERFLOW_PREFIX)
+        caption, caption_entities = chunks[0]
+        post = RenderedPost(media_list, caption, caption_entities, chunks[1:],
+                            source_ids, [msg.id for msg in valid_messages if msg.media])
+        post.protected = any(msg.noforwards for msg in valid_messages)
+        post.rewritten = rewritten
+        post.source_peer = valid_messages[0].peer_id
+        return post
+    if text_content:
+        chunks = split_text(text_content, formatting_entities)
+        post = RenderedPost([], chunks[0][0], chunks[0][1], chunks[1:], source_ids=source_ids)
+        post.protected = any(msg.noforwards for msg in valid_messages)
+        post.rewritten = rewritten
+        return post
+    return None
+
+async def send_rendered_post(post: RenderedPost, channel_entity: Any, on_flood=None) -> list:
+    """发送渲染好的帖子，成功返回目标频道中新消息的 id 列表，失败返回 None
+
+    由发送池选择账号，限流时换用其他账号或等待，超过重试次数后向上抛出；on_flood 在需要等待时被调用。
+    源频道禁止转发时先下载并重新上传媒体
+    """
+    sent_ids = []
     try:
-        # 获取消息组, 前后10条
-        start_id = max(1, message_id - 10)
-        end_id = message_id + 10
-        message_ids = list(range(start_id, end_id))
-        messages = await client.get_messages(entity, ids=message_ids)
-        target_msg = next((msg for msg in messages if msg and msg.id == message_id), None)
-        if not target_msg:
-            logger.warning(f"未找到消息 ID {message_id}")
-            return False
-        if target_msg.grouped_id:
-            valid_messages = [msg for msg in messages if msg and msg.grouped_id == target_msg.grouped_id]
-        else:
-            valid_messages = [target_msg]
-        
-        valid_messages.sort(key=lambda x: x.id)
-        if is_ad_media_group(valid_messages):
-            logger.info(f"检测到广告内容，已跳过（message_id={message_id}）")
-            return False
-        media_list = [msg.media for msg in valid_messages if msg.media]
-        text_content = ""
-        formatting_entities = []
-        text_offset = 0
-        
-        for i, msg in enumerate(valid_messages):
-            if msg.text and msg.text.strip():
-                msg_text = msg.text.strip()
-                if msg.entities and '**' in msg_text:
-                    clean_text = msg_text.replace('**', '')
-                    if msg.entities:
-                        offset_adjustment = 0
-                        adjusted_entities = []
-                        for entity in msg.entities:
-                            text_before_entity = msg_text[:entity.offset]
-                            stars_before = text_before_entity.count('**') * 2  
-                            entity_text = msg_text[entity.offset:entity.offset + entity.length]
-                            stars_in_entity = entity_text.count('**') * 2
-                            new_offset = entity.offset - stars_before
-                            new_length = entity.length - stars_in_entity
-                            if new_length > 0:  
-                                new_entity = entity.__class__(offset=new_offset, length=new_length)
-                                adjusted_entities.append(new_entity)
-                        msg.entities = adjusted_entities
-                    msg_text = clean_text
-                if text_content:
-                    text_content += "\n\n" + msg_text
-                    text_offset += 2  
-                else:
-                    text_content = msg_text
-                if msg.entities:
-                    for entity in msg.entities:
-                        new_entity = entity.__class__(
-                            offset=entity.offset + text_offset,
-                            length=entity.length
-                        )
-                        formatting_entities.append(new_entity)
-                text_offset += len(msg_text)
-        if text_content:
-            original_text = text_content
-            text_content = process_text(text_content)
-        if media_list:
-            # 媒体消息的caption限制1024字符
-            caption = text_content[:1024] if len(text_content) > 1024 else text_content
-            # 过滤适合caption长度的格式化信息
-            caption_entities = []
-            if formatting_entities and len(text_content) <= 1024:
-                caption_entities = formatting_entities
-            elif formatting_entities and len(text_content) > 1024:
-                # 只保留在caption范围内的格式化信息
-                for entity in formatting_entities:
-                    if entity.offset < 1024:
-                        caption_entities.append(entity)
+        if post.media_list:
+            if post.protected:
+                await transfer_post_media(post)
+            # 已中转的媒体优先引用主账号发送过的副本
+            media_list = post.media_list
+            if post.transferred:
+                media_list = [media_cache.get(source) or media
+                              for source, media in zip(post.source_media, media_list)]
             try:
-                sent_messages = await client.send_file(
-                    channel_entity,
+                sent_messages = await sender_pool.call(channel_entity, 'send_file',
+                    channel_entity, on_flood=on_flood, only_primary=post.transferred,
                     file=media_list,
-                    caption=caption,
-                    formatting_entities=caption_entities if caption_entities else None
+                    caption=post.text,
+                    formatting_entities=post.entities if post.entities else None
                 )
-                print("✅ 发送成功")
+            except (errors.ChatForwardsRestrictedError, errors.FileReferenceExpiredError, *FLOOD_ERRORS):
+                raise
             except Exception as e:
-                html_caption = convert_to_html(caption, caption_entities)
-                
-                sent_messages = await client.send_file(
-                    channel_entity,
+                sent_messages = await sender_pool.call(channel_entity, 'send_file',
+                    channel_entity, on_flood=on_flood, only_primary=post.transferred,
                     file=media_list,
-                    caption=html_caption,
+                    caption=post.html,
                     parse_mode='html'
                 )
-                print("✅ 发送成功")
-            # 如果文本过长，剩余部分单独发送
-            if len(text_content) > 1024:
-                remaining_text = text_content[1024:]
-                remaining_entities = []
-                if formatting_entities:
-                    for entity in formatting_entities:
-                        if entity.offset >= 1024:
-                            new_entity = entity.__class__(
-                                offset=entity.offset - 1024,
-                                length=entity.length
-                            )
-                            remaining_entities.append(new_entity)
-                
-                await client.send_message(
-                    channel_entity, 
-                    f"完整内容：\n{remaining_text}",
-                    formatting_entities=remaining_entities if remaining_entities else None
-                )
-        elif text_content:
+            print("✅ 发送成功")
+            if not isinstance(sent_messages, list):
+                sent_messages = [sent_messages]
+            sent_ids.extend(msg.id for msg in sent_messages)
+            post.sender = sender_pool.account_of(sent_messages[0])
+            if post.transferred:
+                remember_uploaded_media(post, sent_messages)
+        else:
             # 尝试使用 formatting_entities
             try:
-                await client.send_message(
+                text_msg = await sender_pool.call(channel_entity, 'send_message',
                     channel_entity, 
-                    text_content, 
-                    formatting_entities=formatting_entities if formatting_entities else None
+                    post.text, on_flood=on_flood,
+                    formatting_entities=post.entities if post.entities else None
                 )
-                print("✅ 发送成功")
+            except FLOOD_ERRORS:
+                raise
             except Exception as e:
-                html_text = convert_to_html(text_content, formatting_entities)
-                
-                await client.send_message(
+                text_msg = await sender_pool.call(channel_entity, 'send_message',
                     channel_entity, 
-                    html_text, 
+                    post.html, on_flood=on_flood,
                     parse_mode='html'
                 )
-                print("✅ 发送成功")
-        
-        return True
+            print("✅ 发送成功")
+            sent_ids.append(text_msg.id)
+            post.sender = sender_pool.account_of(text_msg)
+        for extra_text, extra_entities in post.extra:
+            text_msg = await sender_pool.call(channel_entity, 'send_message',
+                channel_entity, 
+                extra_text, on_flood=on_flood, sender=post.sender,
+                formatting_entities=extra_entities if extra_entities else None
+            )
+            sent_ids.append(text_msg.id)
+        return sent_ids
+    except errors.FileReferenceExpiredError:
+        if not await refresh_post_media(post):
+            logger.error("发送到频道消息失败: 媒体的 file reference 已过期，重新获取失败")
+            return None
+        return await send_rendered_post(post, channel_entity, on_flood)
+    except errors.ChatForwardsRestrictedError:
+        if post.transferred:
+            logger.error("发送到频道消息失败: 重新上传后仍被拒绝")
+            return None
+        # 消息上没有禁止转发标记但发送被拒绝，改为中转媒体后重试
+        post.protected = True
+        return await send_rendered_post(post, channel_entity, on_flood)
     except errors.ChatWriteForbiddenError:
         logger.error(f"发送到频道消息失败: 机器人没有权限向 '{channel_entity}' 频道发送消息")
         logger.error("请确保机器人已加入目标频道并具有发送消息的权限")
-        return False
+        return None
     except errors.ChatAdminRequiredError:
         logger.error(f"发送到频道消息失败: 机器人需要管理员权限才能向 '{channel_entity}' 频道发送消息")
-        return False
+        return None
     except errors.PeerIdInvalidError:
         logger.error(f"发送到频道消息失败: 频道 '{channel_entity}' 不存在或无法访问")
-        return False
-    except errors.FloodWaitError as e:
-        raise e
+        return None
+    except FLOOD_ERRORS:
+        raise
     except Exception as e:
         logger.error(f"发送到频道消息失败: {e}")
-        return False
+        return None
+
+FORWARD_BATCH_SIZE = 100  # 一次 ForwardMessages 请求最多包含的消息数
+
+async def forward_post_batch(entity: Any, batch: list, channel_entity: Any, on_flood=None) -> list:
+    """用一次 forward_messages（drop_author，不显示来源）转发多个无需改写的帖子
+
+    返回每个帖子在目标频道中的消息 id 列表，失败为 None；转发被拒绝时改为逐个重新发送
+    """
+    ids = [src_id for post in batch for src_id in post.source_ids]
+    try:
+        forwarded = await sender_pool.call(channel_entity, 'forward_messages',
+            channel_entity, ids, on_flood=on_flood,
+            from_peer=entity,
+            drop_author=True
+        )
+    except FLOOD_ERRORS:
+        raise
+    except Exception as e:
+        logger.warning(f"原生转发 {len(ids)} 条消息失败: {e}，改为逐个重新发送")
+        for post in batch:
+            post.rewritten = True
+        return [await send_rendered_post(post, channel_entity, on_flood) for post in batch]
+    if not isinstance(forwarded, list):
+        forwarded = [forwarded]
+    print(f"✅ 转发成功（{len(batch)} 个帖子，{len(ids)} 条消息）")
+    sender = sender_pool.account_of(next((msg for msg in forwarded if msg), None))
+    results = []
+    position = 0
+    for post in batch:
+        part = forwarded[position:position + len(post.source_ids)]
+        position += len(post.source_ids)
+        results.append([msg.id for msg in part if msg] or None)
+        post.sender = sender
+    return results
+
+async def send_message_to_channel(entity: Any, message_id: int, channel_entity: Any, add_link: bool = True,
+                                  rules: TextRules = None, ad_stats: Counter = None,
+                                  member_ids: list = None, prefetch_ids: list = None) -> list:
+    """克隆一个帖子到目标频道，成功返回目标频道中新消息的 id 列表，失败或跳过返回 None"""
+    try:
+        valid_messages = await fetch_message_group(entity, message_id, member_ids, prefetch_ids)
+        if not valid_messages:
+            logger.warning(f"未找到消息 ID {message_id}")
+            return None
+        ad_keyword = is_ad_media_group(valid_messages, rules)
+        if ad_keyword:
+            logger.info(f"检测到广告内容（关键词: {ad_keyword}），已跳过（message_id={message_id}）")
+            if ad_stats is not None:
+                ad_stats[ad_keyword] += 1
+            return None
+        post = render_post(valid_messages, rules)
+        if post is None:
+            return []
+        dst_chat = await target_chat_id(channel_entity)
+        if dst_chat is not None and dedup_index.contains(dst_chat, post.fingerprint):
+            logger.info(f"目标频道已有相同内容，已跳过（message_id={message_id}）")
+            return []
+        if post.forwardable:
+            sent_ids = (await forward_post_batch(entity, [post], channel_entity))[0]
+        else:
+            sent_ids = await send_rendered_post(post, channel_entity)
+        if sent_ids and dst_chat is not None:
+            dedup_index.add(dst_chat, post.fingerprint, sent_ids[0])
+        await message_map.record(entity, post, channel_entity, sent_ids)
+        return sent_ids
+    except FLOOD_ERRORS:
+        raise
+    except Exception as e:
+        logger.error(f"发送到频道消息失败: {e}")
+        return None
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """当用户发送 /start 命令时的处理函数"""
     if not update.message:
@@ -484,10 +1887,15 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     help_text += '/random https://t.me/channel_name/message_id     # 随机发送10条消息\n'
     help_text += '/random https://t.me/channel_name/message_id 5   # 随机发送5条消息\n'
     help_text += '/clear                                           # 删除最近发送的消息\n'
-    help_text += '/collectlinks @yourchannel                       # 收集频道历史消息链接\n'
+    help_text += '/collectlinks @yourchannel                       # 收集频道历史消息（已收集过则只追加新消息）\n'
     help_text += '/listlinks                                       # 查看已收集的频道数据\n'
-    help_text += '/sendto yourchannel_links.txt @targetchannel     # 克隆频道到目标频道\n'
-    help_text += '/stop                                            # 停止批量转发任务\n\n'
+    help_text += '/sendto @yourchannel @targetchannel              # 克隆频道到目标频道\n'
+    help_text += '/sendto @yourchannel @targetchannel resume       # 从上次中断处继续克隆\n'
+    help_text += '/sendto @yourchannel @target1 @target2           # 同时克隆到多个频道\n'
+    help_text += '/mirror @yourchannel @targetchannel              # 实时镜像频道新消息\n'
+    help_text += '/mirror stop @yourchannel                        # 停止实时镜像\n'
+    help_text += '/stop                                            # 停止批量转发任务\n'
+    help_text += '/pool                                            # 查看发送账号状态\n\n'
     help_text += '📝 文本处理配置命令：\n'
     help_text += '/config                                          # 查看当前配置\n'
     help_text += '/config replace 原文本:新文本                    # 添加替换规则\n'
@@ -526,6 +1934,86 @@ async def process_message_link(update: Update, context: ContextTypes.DEFAULT_TYP
     if not success:
         message = await update.message.reply_text('无法获取该消息，请检查链接或权限。')
         await track_bot_message(update.effective_user.id, message)
+RANDOM_SEND_CONCURRENCY = 4  # /random 同时发送的帖子数，实际速率仍由限流器控制
+RANDOM_FETCH_ROUNDS = 3  # 没有索引时最多请求几批随机 id
+
+def sample_index_posts(channel_name: str, max_id: int, count: int) -> list:
+    """从频道索引中无放回地随机抽取 count 个 id 不超过 max_id 的帖子，返回 [(message_id, member_ids)]
+
+    蓄水池抽样，只扫描一遍索引，媒体组本来就只占一行
+    """
+    sample = []
+    seen = 0
+    for row in iter_index_rows(channel_name):
+        if row['id'] > max_id or not (row['media'] or row['len']):
+            continue
+        seen += 1
+        if len(sample) < count:
+            sample.append(row)
+        else:
+            j = random.randrange(seen)
+            if j < count:
+                sample[j] = row
+    random.shuffle(sample)
+    return [(row['id'], row['members']) for row in sample]
+
+async def sample_random_ids(entity, max_id: int, count: int) -> list:
+    """没有索引时，每批用一次 GetMessages 请求 100 个随机 id，保留存在的消息，返回 [(message_id, member_ids)]
+
+    同一媒体组只保留一次，组内成员未知（member_ids 为 None），发送时再按前后 id 查找
+    """
+    tried = set()
+    groups = set()
+    candidates = []
+    for _ in range(RANDOM_FETCH_ROUNDS):
+        remaining = max_id - len(tried)
+        if remaining <= 0:
+            break
+        size = min(PREFETCH_CHUNK, remaining)
+        if remaining <= PREFETCH_CHUNK * 2:
+            ids = random.sample([i for i in range(1, max_id + 1) if i not in tried], size)
+        else:
+            ids = set()
+            while len(ids) < size:
+                rand_id = random.randint(1, max_id)
+                if rand_id not in tried:
+                    ids.add(rand_id)
+            ids = list(ids)
+        tried.update(ids)
+        messages = await message_cache.get_messages(client, entity, ids)
+        for msg in messages:
+            # 跳过不存在的 id、服务消息和空消息
+            if not msg or getattr(msg, 'action', None) or not (msg.message or msg.media):
+                continue
+            if msg.grouped_id:
+                if msg.grouped_id in groups:
+                    continue
+                groups.add(msg.grouped_id)
+                candidates.append((msg.id, None))
+            else:
+                candidates.append((msg.id, [msg.id]))
+        if len(candidates) >= count * 2:
+            break
+    random.shuffle(candidates)
+    return candidates
+
+async def send_random_posts(entity, candidates: list, send_count: int, user_id, rules: TextRules) -> int:
+    """并发发送候选帖子直到成功 send_count 条，失败的名额由后面的候选补上，返回成功数"""
+    semaphore = asyncio.Semaphore(RANDOM_SEND_CONCURRENCY)
+
+    async def send(message_id, member_ids):
+        async with semaphore:
+            return await send_message_to_user(entity, message_id, user_id, rules=rules, member_ids=member_ids)
+
+    sent_count = 0
+    pos = 0
+    while sent_count < send_count and pos < len(candidates):
+        batch = candidates[pos:pos + send_count - sent_count]
+        pos += len(batch)
+        results = await asyncio.gather(*(send(message_id, member_ids) for message_id, member_ids in batch))
+        sent_count += sum(1 for result in results if result)
+    return sent_count
+
 async def random_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """根据提供的消息链接随机发送指定数量的消息"""
     if not update.message:
@@ -559,31 +2047,20 @@ async def random_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 message = await update.message.reply_text('请输入有效的数字作为发送数量。')
                 await track_bot_message(update.effective_user.id, message)
                 return
-        user_sent_messages[update.effective_user.id] = []
-        user_command_messages[update.effective_user.id] = []
-        sent_count = 0
-        attempts = 0
-        max_attempts = send_count * 5  # 最多尝试次数为目标数量的5倍
-        while sent_count < send_count and attempts < max_attempts:
-            rand_id = random.randint(1, max_message_id)
-            attempts += 1
-            max_retries = 3
-            retry_count = 0
-            success = False
-            while retry_count < max_retries and not success:
-                try:
-                    success = await send_message_to_user(entity, rand_id, update.effective_user.id)
-                    if success:
-                        sent_count += 1
-                    success = True  # 标记为已处理
-                except errors.FloodWaitError as e:
-                    retry_count += 1
-                    wait_time = e.seconds
-                    logger.warning(f"随机消息遇到限流，等待 {wait_time} 秒后重试")
-                    await asyncio.sleep(wait_time + 1)
-                except Exception as e:
-                    logger.error(f"发送随机消息时出错: {e}")
-                    success = True  # 标记为已处理
+        message_tracker.clear(update.effective_user.id)
+        rules = get_text_rules()
+        # 收集过的频道从索引中抽样（多抽一半作为后备），否则批量请求随机 id
+        channel_name = safe_channel_name(str(entity))
+        meta = read_index_meta(channel_name)
+        if meta and os.path.isfile(get_index_file(channel_name)):
+            entity = meta['entity']
+            candidates = sample_index_posts(channel_name, max_message_id, send_count + (send_count + 1) // 2)
+            # 所有候选的成员合并成几次 GetMessages 预取
+            await message_cache.get_messages(client, entity, [mid for _, members in candidates for mid in members])
+        else:
+            candidates = await sample_random_ids(entity, max_message_id, send_count)
+        # 限流等待和重试由共享限流器处理
+        sent_count = await send_random_posts(entity, candidates, send_count, update.effective_user.id, rules)
         if sent_count > 0:
             message = await update.message.reply_text(f'已成功发送 {sent_count} 条随机消息！\n使用 /clear 可以删除这些消息。')
             await track_bot_message(update.effective_user.id, message)
@@ -596,6 +2073,26 @@ async def random_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         message = await update.message.reply_text(f'获取随机消息时出错: {str(e)}')
         await track_bot_message(update.effective_user.id, message)
 
+DELETE_BATCH_SIZE = 100  # 单次 DeleteMessages 请求的最大 id 数
+
+async def delete_message_batch(chat_id, ids: list) -> list:
+    """删除一批消息，返回未能删除的 id
+
+    删除数与请求数一致时直接返回；否则（或请求失败时）用一次 GetMessages 核对，仍然存在的即为失败，不逐条重试
+    """
+    try:
+        affected = await limited_call(client, chat_id, client.delete_messages, chat_id, ids)
+        if sum(item.pts_count for item in affected or []) >= len(ids):
+            return []
+    except Exception as e:
+        logger.warning(f"批量删除 {len(ids)} 条消息失败: {e}")
+    try:
+        remaining = await limited_call(client, chat_id, client.get_messages, chat_id, ids=ids)
+    except Exception as e:
+        logger.error(f"核对删除结果失败: {e}")
+        return list(ids)
+    return [msg.id for msg in remaining if msg]
+
 async def clear_messages(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """删除最近发送给用户的消息以及用户的指令消息"""
     if not update.message:
@@ -603,10 +2100,8 @@ async def clear_messages(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     try:
         user_id = update.effective_user.id
         
-        # 获取要删除的消息列表
-        bot_messages = user_sent_messages.get(user_id, [])
-        user_messages = user_command_messages.get(user_id, [])
-        all_messages = bot_messages + user_messages
+        # 获取要删除的消息列表（超过48小时的记录已过期，机器人无法删除）
+        all_messages = message_tracker.get(user_id)
         
         if not all_messages:
             message = await update.message.reply_text('没有可删除的消息。')
@@ -615,37 +2110,36 @@ async def clear_messages(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         
         # 添加当前清理命令消息到删除列表
         all_messages.append(update.message.message_id)
+        all_messages = list(dict.fromkeys(all_messages))
         
-        deleted_count = 0
         status_message = await update.message.reply_text(f'正在删除 {len(all_messages)} 条消息...')
         
-        # 批量删除消息
-        for msg_id in all_messages:
-            try:
-                await client.delete_messages(user_id, msg_id)
-                deleted_count += 1
-            except Exception as e:
-                logger.error(f"删除消息 {msg_id} 失败: {e}")
+        # 每100条一批，各批通过共享限流器并发删除
+        chunks = [all_messages[i:i + DELETE_BATCH_SIZE] for i in range(0, len(all_messages), DELETE_BATCH_SIZE)]
+        results = await asyncio.gather(*(delete_message_batch(user_id, chunk) for chunk in chunks))
+        failed = sorted(msg_id for chunk_failed in results for msg_id in chunk_failed)
+        deleted_count = len(all_messages) - len(failed)
+        if failed:
+            logger.warning(f"用户 {user_id} 有 {len(failed)} 条消息未能删除: {failed}")
         
         # 清空记录
-        user_sent_messages[user_id] = []
-        user_command_messages[user_id] = []
+        message_tracker.clear(user_id)
         
         # 删除状态消息
         try:
-            await client.delete_messages(user_id, status_message.message_id)
+            await limited_call(client, user_id, client.delete_messages, user_id, status_message.message_id)
         except:
             pass
         
-        if deleted_count > 0:
+        if deleted_count > 0 and not failed:
             result_message = await update.message.reply_text(f'已成功删除 {deleted_count} 条消息！')
             # 延迟删除结果消息
-            import asyncio
-            await asyncio.sleep(3)
-            try:
-                await client.delete_messages(user_id, result_message.message_id)
-            except:
-                pass
+            await delete_message_later(user_id, result_message.message_id, 3)
+        elif deleted_count > 0:
+            shown = ', '.join(str(msg_id) for msg_id in failed[:20]) + (' 等' if len(failed) > 20 else '')
+            message = await update.message.reply_text(
+                f'已删除 {deleted_count} 条消息，{len(failed)} 条删除失败（可能超过48小时）：{shown}')
+            await track_bot_message(user_id, message)
         else:
             message = await update.message.reply_text('删除失败，可能消息已被删除或超过48小时。')
             await track_bot_message(user_id, message)
@@ -655,6 +2149,14 @@ async def clear_messages(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         message = await update.message.reply_text(f'删除消息时出错: {str(e)}')
         await track_bot_message(update.effective_user.id, message)
 
+async def delete_message_later(chat_id, message_id: int, delay: float) -> None:
+    """延迟删除一条提示消息，失败时忽略"""
+    await asyncio.sleep(delay)
+    try:
+        await limited_call(client, chat_id, client.delete_messages, chat_id, message_id)
+    except Exception:
+        pass
+
 async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """处理非链接消息"""
     # 检查 update.message 是否存在
@@ -669,6 +2171,14 @@ async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     message = await update.message.reply_text('请发送 Telegram 消息链接。如需帮助，请使用 /help 命令。')
     await track_bot_message(update.effective_user.id, message)
 
+async def pool_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """查看发送池中各账号的吞吐量和状态"""
+    if not update.message:
+        return
+    await track_user_message(update)
+    message = await update.message.reply_text(f'📤 发送池（{len(sender_pool.accounts)} 个账号）：\n{sender_pool.summary()}')
+    await track_bot_message(update.effective_user.id, message)
+
 async def stop_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """停止批量转发任务"""
     if not update.message:
@@ -691,8 +2201,12 @@ async def config_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         config_text += f"🗑️ 删除规则：\n{dynamic_config['delete_patterns'] or '无'}\n\n"
         config_text += f"➕ 追加文本：\n{dynamic_config['append_text'] or '无'}\n\n"
         config_text += f"🚫 广告关键词：\n{dynamic_config['ad_keywords'] or '无'}\n\n"
+        block_keywords = dynamic_config.get('block_keywords') or []
+        if block_keywords:
+            config_text += f"⛔ 屏蔽关键词（config.json）：\n{' | '.join(map(str, block_keywords))}\n\n"
         delay = dynamic_config.get('delay_seconds', 1.0)
-        config_text += f"⏱️ 发送延迟：{delay} 秒（克隆发送时每条消息的间隔时间）\n\n"
+        config_text += f"⏱️ 发送延迟：{delay} 秒（克隆发送时的初始间隔，之后按限流情况自动调整）\n"
+        config_text += f"🚦 限流状态：{rate_limiter.summary()}\n\n"
         config_text += "📝 使用方法：\n"
         config_text += "• /config replace 原文本:新文本\n"
         config_text += "• /config delete 正则表达式\n"
@@ -884,6 +2398,8 @@ async def config_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     summary += f"➕ 追加文本: 已设置\n"
                 if loaded_config.get('ad_keywords'):
                     summary += f"🚫 广告关键词: {len(loaded_config['ad_keywords'].split('|'))} 个\n"
+                if loaded_config.get('block_keywords'):
+                    summary += f"⛔ 屏蔽关键词: {len(loaded_config['block_keywords'])} 个\n"
                 if loaded_config.get('delay_seconds'):
                     summary += f"⏱️ 发送延迟: {loaded_config['delay_seconds']} 秒\n"
                 
@@ -895,6 +2411,11 @@ async def config_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     else:
         await update.message.reply_text("❌ 未知命令！使用 /config 查看帮助")
+        return
+
+    # 配置可能已变更，重新编译规则快照并更新限流参数
+    refresh_text_rules()
+    rate_limiter.configure(dynamic_config)
 
 async def test_config_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """测试文本处理配置"""
@@ -917,54 +2438,259 @@ async def test_config_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         result_text += "ℹ️ 文本未发生变化"
     else:
         result_text += "✅ 文本已处理"
+    ad_keyword = get_text_rules().ad_matcher.search(test_text)
+    if ad_keyword:
+        result_text += f"\n🚫 命中广告关键词：{ad_keyword}（克隆时将跳过）"
     
     message = await update.message.reply_text(result_text)
     await track_bot_message(update.effective_user.id, message)
 
-async def collect_channel_history_links(entity: Any, save_path: str) -> None:
-    """收集整个频道历史消息的链接并保存，媒体组只保存一次。"""
+INDEX_WRITE_BATCH = 500  # 索引每攒够多少行写盘一次
+COLLECT_PAGE_INTERVAL = 0.3  # 两次 GetHistory 请求（每次100条）之间的间隔秒数，可在 config.json 中用 collect_page_interval 修改
+COLLECT_WORKERS = 4  # 并行收集的分段数，可在 config.json 中用 collect_workers 修改
+COLLECT_SHARD_MIN_SIZE = 2000  # 每段至少包含的 id 数，区间较小时不分段
+
+def read_index_row_at(channel_name: str, offset: int) -> dict:
+    """读取索引中从 offset 字节开始的一行"""
+    with open(get_index_file(channel_name), 'rb') as f:
+        f.seek(offset)
+        return json.loads(f.readline().decode('utf-8'))
+
+class IndexWriter:
+    """流式写入频道索引：行先进入缓冲区，攒够一批后从上次写到的位置覆盖写入，并同步更新元数据。
+
+    每批写完都会更新元数据，中途中断后下次可以增量继续收集。
+    """
+
+    def __init__(self, channel_name: str, entity: Any, meta: dict = None, last_row: dict = None):
+        self.channel_name = channel_name
+        self.entity = entity
+        path = get_index_file(channel_name)
+        self.file = open(path, 'r+b' if os.path.isfile(path) else 'w+b')
+        # 增量写入时从原最后一行 last_row 处开始覆盖，它会由调用方合并新消息后重新写入
+        self.pos = meta['last_offset'] if meta else 0
+        self.last_offset = self.pos
+        self.count = meta['count'] if meta else 0
+        self.media_count = meta['media_count'] if meta else 0
+        if last_row:
+            self.count -= 1
+            self.media_count -= 1 if last_row['media'] else 0
+        self.max_id = meta['max_id'] if meta else 0
+        self.start_count = meta['count'] if meta else 0
+        self.buffer = []
+
+    def write(self, row: dict) -> None:
+        self.buffer.append(row)
+        if len(self.buffer) >= INDEX_WRITE_BATCH:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.buffer:
+            return
+        self.file.seek(self.pos)
+        for row in self.buffer:
+            self.last_offset = self.file.tell()
+            self.file.write((json.dumps(row, separators=(',', ':')) + '\n').encode('utf-8'))
+            self.count += 1
+            self.media_count += 1 if row['media'] else 0
+            self.max_id = max(self.max_id, max(row['members']))
+        self.pos = self.file.tell()
+        self.file.truncate()
+        self.file.flush()
+        self.buffer = []
+        self.write_meta()
+
+    def write_meta(self) -> None:
+        write_index_meta(self.channel_name, {
+            'entity': self.entity,
+            'count': self.count,
+            'media_count': self.media_count,
+            'max_id': self.max_id,
+            'last_offset': self.last_offset,
+            'updated': int(time.time()),
+        })
+
+    def close(self) -> None:
+        if self.buffer:
+            self.flush()
+        elif self.count == 0:
+            # 频道没有任何消息，也写出空索引和元数据
+            self.file.seek(0)
+            self.file.truncate()
+            self.write_meta()
+        self.file.close()
+
+def split_id_range(min_id: int, top_id: int, shards: int) -> list:
+    """把 (min_id, top_id] 切分成若干连续区间，返回 [(下界, 上界)]，下界不含、上界含"""
+    span = top_id - min_id
+    shards = max(1, min(shards, span // COLLECT_SHARD_MIN_SIZE))
+    bounds = [min_id + span * k // shards for k in range(shards + 1)]
+    return [(bounds[k], bounds[k + 1]) for k in range(shards)]
+
+def get_collect_clients() -> list:
+    """可用于读取频道历史的客户端：用户客户端，加上发送池中的用户账号"""
+    return [user_client] + [account.client for account in sender_pool.accounts
+                            if not account.is_bot and account.client is not user_client]
+
+async def collect_range_rows(tg_client, entity: Any, low: int, high: int, part_file: str,
+                             page_interval: float, progress: dict, key: int) -> None:
+    """收集 (low, high] 区间的消息，媒体组合并后逐行写入分段临时文件，progress[key] 记录已处理条数"""
+    from telethon.tl.types import Message
+
+    peer = await entity_resolver.resolve(tg_client, entity)
+    current_row = None
+    last_id = low
+    progress[key] = 0
+    with open(part_file, 'w', encoding='utf-8') as f:
+        while True:
+            try:
+                async for msg in tg_client.iter_messages(peer, reverse=True, min_id=last_id, max_id=high + 1,
+                                                         wait_time=page_interval):
+                    last_id = msg.id
+                    if not isinstance(msg, Message):
+                        continue
+                    if current_row and msg.grouped_id and msg.grouped_id == current_row['gid']:
+                        merge_index_row(current_row, msg)
+                        continue
+                    if current_row:
+                        f.write(json.dumps(current_row, separators=(',', ':')) + '\n')
+                    current_row = build_index_row(msg)
+                    progress[key] += 1
+                break
+            except FLOOD_ERRORS as e:
+                # 只等待这一段，从最后读到的消息继续，其他分段不受影响
+                logger.warning(f"收集 ({low}, {high}] 时触发限流，等待 {e.seconds} 秒后继续")
+                await asyncio.sleep(e.seconds)
+        if current_row:
+            f.write(json.dumps(current_row, separators=(',', ':')) + '\n')
+
+async def collect_shards(entity: Any, shards: list, part_files: list, page_interval: float, progress: dict) -> None:
+    """多个客户端并行收集各分段，第 k 段写入 part_files[k]"""
+    clients = get_collect_clients()
+    print(f"分 {len(shards)} 段并行收集，使用 {min(len(clients), len(shards))} 个账号")
+
+    async def run_shard(k: int) -> None:
+        low, high = shards[k]
+        tg_client = clients[k % len(clients)]
+        try:
+            await collect_range_rows(tg_client, entity, low, high, part_files[k], page_interval, progress, k)
+        except (errors.RPCError, ValueError) as e:
+            if tg_client is user_client:
+                raise
+            # 其他账号可能没有加入该频道，改用用户客户端重新收集这一段
+            logger.warning(f"账号 {client_label(tg_client)} 收集 ({low}, {high}] 失败: {e}，改用用户客户端")
+            await collect_range_rows(user_client, entity, low, high, part_files[k], page_interval, progress, k)
+
+    await asyncio.gather(*(run_shard(k) for k in range(len(shards))))
+
+def print_collect_progress(processed_count: int, total_count: int) -> None:
+    progress = min(100.0, (processed_count / total_count) * 100)
+    bar_length = 30
+    filled_length = min(bar_length, int(bar_length * processed_count // total_count))
+    bar = '█' * filled_length + '-' * (bar_length - filled_length)
+    print(f'\r进度: |{bar}| {progress:.1f}% ({processed_count}/{total_count})', end='', flush=True)
+
+async def collect_channel_history_links(entity: Any, channel_name: str, full: bool = False):
+    """流式收集频道历史消息并写入结构化索引，媒体组合并为一行。
+
+    已有索引时只收集上次最大 id 之后的新消息并追加；full=True 时重新收集全部。
+    待收集的 id 区间较大时，按 id 分段由多个账号并行收集，再按顺序合并到索引，
+    跨越分段边界的媒体组会合并回同一行。
+    返回 (帖子总数, 本次新增帖子数)。
+    """
     from telethon.tl.types import Message
     
     if not USER_CLIENT_READY:
         raise RuntimeError("用户客户端未启动，无法收集频道历史消息。请检查两步验证设置。")
     
-    # 首先获取总消息数
-    total_count = (await user_client.get_messages(entity, limit=0)).total
-    links = []
-    grouped_ids = set()
+    save_path = get_index_file(channel_name)
+    meta = None if full else read_index_meta(channel_name)
+    if meta and ('last_offset' not in meta or not os.path.isfile(save_path)):
+        meta = None
+    min_id = meta['max_id'] if meta else 0
     
-    print(f"开始收集 {total_count} 条消息...")
-    processed_count = 0
+    # 增量收集时，先取出索引的最后一行：新消息可能与它属于同一个媒体组
+    current_row = None
+    if meta and meta['count']:
+        current_row = read_index_row_at(channel_name, meta['last_offset'])
     
-    async for msg in user_client.iter_messages(entity, reverse=True):
-        if not isinstance(msg, Message):
-            continue
-        # 媒体组去重
-        if msg.grouped_id:
-            if msg.grouped_id in grouped_ids:
-                continue
-            grouped_ids.add(msg.grouped_id)
-        link = build_link(entity, msg.id)
-        links.append(link)
-        
-        processed_count += 1
-        # 每处理10条消息显示一次进度
-        if processed_count % 10 == 0 or processed_count == total_count:
-            progress = (processed_count / total_count) * 100
-            bar_length = 30
-            filled_length = int(bar_length * processed_count // total_count)
-            bar = '█' * filled_length + '-' * (bar_length - filled_length)
-            print(f'\r进度: |{bar}| {progress:.1f}% ({processed_count}/{total_count})', end='', flush=True)
-        
-        await asyncio.sleep(0.01)  # 每收集一条消息间隔0.01秒，防止被限流
+    # 频道最新消息的 id 决定需要收集的区间
+    peer = await entity_resolver.resolve(user_client, entity)
+    latest = await user_client.get_messages(peer, limit=1)
+    top_id = latest[0].id if latest else min_id
+    total_count = max(1, top_id - min_id)
     
-    print()  # 换行
+    print(f"开始收集约 {total_count} 条消息...")
+    writer = IndexWriter(channel_name, entity, meta, current_row)
+    # 按请求节流：每页 GetHistory 之间间隔固定时间，而不是每条消息都等待
+    page_interval = float(dynamic_config.get('collect_page_interval', COLLECT_PAGE_INTERVAL))
+    shards = split_id_range(min_id, top_id, int(dynamic_config.get('collect_workers', COLLECT_WORKERS)))
+    part_files = [f"{save_path}.part{k}" for k in range(len(shards))] if len(shards) > 1 else []
+    
+    try:
+        if part_files:
+            progress = {}
+            shard_task = asyncio.create_task(collect_shards(entity, shards, part_files, page_interval, progress))
+            try:
+                while not shard_task.done():
+                    await asyncio.wait({shard_task}, timeout=1)
+                    print_collect_progress(sum(progress.values()), total_count)
+            finally:
+                shard_task.cancel()
+            shard_task.result()
+            # 按区间顺序合并分段结果，前一段末尾与后一段开头属于同一媒体组时合并为一行
+            for part_file in part_files:
+                with open(part_file, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        row = json.loads(line)
+                        if current_row and row['gid'] and row['gid'] == current_row['gid']:
+                            merge_index_rows(current_row, row)
+                            continue
+                        if current_row:
+                            writer.write(current_row)
+                        current_row = row
+        else:
+            processed_count = 0
+            async for msg in user_client.iter_messages(peer, reverse=True, min_id=min_id, wait_time=page_interval):
+                if not isinstance(msg, Message):
+                    continue
+                # 媒体组在正序遍历中是连续的，同组消息合并到同一行
+                if current_row and msg.grouped_id and msg.grouped_id == current_row['gid']:
+                    if msg.id not in current_row['members']:
+                        merge_index_row(current_row, msg)
+                    continue
+                if current_row:
+                    writer.write(current_row)
+                current_row = build_index_row(msg)
+                
+                processed_count += 1
+                # 每处理100条消息显示一次进度
+                if processed_count % 100 == 0:
+                    print_collect_progress(processed_count, total_count)
+        if current_row:
+            writer.write(current_row)
+    finally:
+        writer.close()
+        for part_file in part_files:
+            if os.path.exists(part_file):
+                os.remove(part_file)
     
-    # 保存到文件
-    with open(save_path, 'w', encoding='utf-8') as f:
-        for link in links:
-            f.write(link + '\n')
-    print(f"已保存 {len(links)} 条数据到 {save_path}")
+    print()  # 换行
+    new_count = writer.count - writer.start_count
+    print(f"已保存 {writer.count} 条数据到 {save_path}（新增 {new_count} 条）")
+    return writer.count, new_count
+
+def parse_channel_input(channel_input: str):
+    """把用户输入的频道（@用户名、频道链接或数字 id）转换为 Telethon 可识别的实体"""
+    if channel_input.startswith('https://t.me/'):
+        # 如果是链接，提取频道名
+        channel_entity = channel_input.replace('https://t.me/', '').lstrip('@')
+    else:
+        # 直接使用频道名或ID
+        channel_entity = channel_input.lstrip('@')
+    if re.fullmatch(r'-?\d+', channel_entity):
+        channel_entity = int(channel_entity)
+    return channel_entity
 
 def safe_channel_name(channel: str) -> str:
     """提取用户名或ID，并去除特殊字符"""
@@ -974,49 +2700,91 @@ def safe_channel_name(channel: str) -> str:
     channel = re.sub(r'[^a-zA-Z0-9_\-]', '', channel)
     return channel
 
+# 实体类型 → (开始标签, 结束标签)，需要属性的类型在 entity_html_tags 中单独处理
+HTML_TAGS = {
+    'MessageEntityBold': ('<b>', '</b>'),
+    'MessageEntityItalic': ('<i>', '</i>'),
+    'MessageEntityUnderline': ('<u>', '</u>'),
+    'MessageEntityStrike': ('<s>', '</s>'),
+    'MessageEntitySpoiler': ('<tg-spoiler>', '</tg-spoiler>'),
+    'MessageEntityCode': ('<code>', '</code>'),
+}
+
+def entity_html_tags(entity, entity_text: str):
+    """返回实体对应的 (开始标签, 结束标签)，不需要标签的实体（话题标签、链接文本等）返回 None"""
+    entity_type = entity.__class__.__name__
+    if entity_type in HTML_TAGS:
+        return HTML_TAGS[entity_type]
+    if entity_type == 'MessageEntityPre':
+        if entity.language:
+            return f'<pre><code class="language-{html_escape(entity.language)}">', '</code></pre>'
+        return '<pre>', '</pre>'
+    if entity_type == 'MessageEntityTextUrl':
+        return f'<a href="{html_escape(entity.url)}">', '</a>'
+    if entity_type == 'MessageEntityMentionName':
+        return f'<a href="tg://user?id={entity.user_id}">', '</a>'
+    if entity_type == 'MessageEntityMention':
+        return f'<a href="https://t.me/{html_escape(entity_text.lstrip("@"))}">', '</a>'
+    if entity_type == 'MessageEntityBlockquote':
+        return ('<blockquote expandable>' if entity.collapsed else '<blockquote>'), '</blockquote>'
+    if entity_type == 'MessageEntityCustomEmoji':
+        return f'<tg-emoji emoji-id="{entity.document_id}">', '</tg-emoji>'
+    return None
+
 def convert_to_html(text: str, entities: list) -> str:
-    """将格式化实体转换为 HTML 格式"""
-    if not entities:
-        return text
-    
-    # 按偏移量排序
-    entities = sorted(entities, key=lambda x: x.offset)
-    
-    # 从后往前处理，避免偏移量变化
-    result = text
-    for entity in reversed(entities):
-        start = entity.offset
-        end = entity.offset + entity.length
-        
-        if start >= len(result) or end > len(result):
-            continue
-            
-        entity_text = result[start:end]
-        
-        if hasattr(entity, '__class__'):
-            entity_type = entity.__class__.__name__
-            
-            if entity_type == 'MessageEntityBold':
-                html_text = f"<b>{entity_text}</b>"
-            elif entity_type == 'MessageEntityItalic':
-                html_text = f"<i>{entity_text}</i>"
-            elif entity_type == 'MessageEntityCode':
-                html_text = f"<code>{entity_text}</code>"
-            elif entity_type == 'MessageEntityPre':
-                html_text = f"<pre>{entity_text}</pre>"
-            elif entity_type == 'MessageEntityTextUrl':
-                html_text = f'<a href="{entity.url}">{entity_text}</a>'
-            elif entity_type == 'MessageEntityMention':
-                html_text = f"<a href=\"https://t.me/{entity_text.lstrip('@')}\">{entity_text}</a>"
+    """将格式化实体转换为 HTML 格式
+
+    实体偏移按 UTF-16 换算，开始/结束事件排序后一次扫描输出，文本中的 <、>、& 被转义；
+    交叉的实体在交叉处先关闭内层标签再重新打开，保证标签正确嵌套
+    """
+    tagged = []
+    for start, end, entity in entity_spans(text, entities):
+        tags = entity_html_tags(entity, text[start:end])
+        if tags:
+            tagged.append((start, end, tags))
+    if not tagged:
+        return html_escape(text, quote=False)
+
+    # 同一位置先打开外层（结束更晚的）实体
+    opens = sorted(range(len(tagged)), key=lambda i: (tagged[i][0], -tagged[i][1]))
+    closes = sorted(range(len(tagged)), key=lambda i: tagged[i][1])
+
+    pieces = []
+    stack = []
+    last = 0
+    oi = ci = 0
+    while ci < len(closes):
+        pos = tagged[closes[ci]][1]
+        if oi < len(opens):
+            pos = min(pos, tagged[opens[oi]][0])
+        pieces.append(html_escape(text[last:pos], quote=False))
+        last = pos
+        # 关闭在此结束的实体，被连带关闭的内层实体等全部关闭后再重新打开
+        ending = set()
+        while ci < len(closes) and tagged[closes[ci]][1] == pos:
+            ending.add(closes[ci])
+            ci += 1
+        reopen = []
+        while ending:
+            top = stack.pop()
+            pieces.append(tagged[top][2][1])
+            if top in ending:
+                ending.discard(top)
             else:
-                html_text = entity_text
-            
-            result = result[:start] + html_text + result[end:]
-    
-    return result
+                reopen.append(top)
+        for top in reversed(reopen):
+            pieces.append(tagged[top][2][0])
+            stack.append(top)
+        while oi < len(opens) and tagged[opens[oi]][0] == pos:
+            index = opens[oi]
+            oi += 1
+            pieces.append(tagged[index][2][0])
+            stack.append(index)
+    pieces.append(html_escape(text[last:], quote=False))
+    return ''.join(pieces)
 
 async def collectlinks_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """收集频道历史消息链接并保存为 txt 文件，媒体组只保存一次。"""
+    """收集频道历史消息并保存为结构化索引，媒体组只保存一次。"""
     if not update.message:
         return
     await track_user_message(update)
@@ -1033,36 +2801,28 @@ async def collectlinks_command(update: Update, context: ContextTypes.DEFAULT_TYP
         args = context.args if hasattr(context, 'args') else []
         if not args:
             message = await update.message.reply_text(
-                '用法: /collectlinks <频道用户名或ID>\n例如: /collectlinks @yourchannel 或 /collectlinks https://t.me/yourchannel')
+                '用法: /collectlinks <频道用户名或ID> [full]\n例如: /collectlinks @yourchannel 或 /collectlinks https://t.me/yourchannel\n'
+                '已收集过的频道只会追加新消息，加 full 参数重新收集全部历史')
             await track_bot_message(update.effective_user.id, message)
             return
         channel_input = args[0]
+        full = len(args) > 1 and args[1].lower() == 'full'
         channel_name = safe_channel_name(channel_input)
-        save_file = get_links_file(channel_name)
+        save_file = get_index_file(channel_name)
         
         # 解析频道实体
         try:
-            if channel_input.startswith('https://t.me/'):
-                # 如果是链接，提取频道名
-                channel_entity = channel_input.replace('https://t.me/', '').lstrip('@')
-            else:
-                # 直接使用频道名或ID
-                channel_entity = channel_input.lstrip('@')
+            channel_entity = parse_channel_input(channel_input)
             
             message = await update.message.reply_text(f'正在收集 {channel_input} 的数据，请稍候...')
             await track_bot_message(update.effective_user.id, message)
-            await collect_channel_history_links(channel_entity, save_file)
+            count, new_count = await collect_channel_history_links(channel_entity, channel_name, full)
         except Exception as e:
             logger.error(f"解析频道实体失败: {e}")
             message = await update.message.reply_text(f'无法解析频道 {channel_input}，请检查频道名或链接是否正确。')
             await track_bot_message(update.effective_user.id, message)
             return
-        # 统计收集到的条数
-        count = 0
-        if os.path.isfile(save_file):
-            with open(save_file, 'r', encoding='utf-8') as f:
-                count = sum(1 for _ in f if _.strip())
-        message2 = await update.message.reply_text(f'收集完成，收集了 {count} 条数据，已保存到 {save_file}。')
+        message2 = await update.message.reply_text(f'收集完成，新增 {new_count} 条，共 {count} 条数据，已保存到 {save_file}。')
         await track_bot_message(update.effective_user.id, message2)
     except Exception as e:
         logger.error(f'/collectlinks 命令处理错误: {e}')
@@ -1070,24 +2830,30 @@ async def collectlinks_command(update: Update, context: ContextTypes.DEFAULT_TYP
         await track_bot_message(update.effective_user.id, message)
 
 async def listlinks_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """列出所有已收集的频道链接文件及其消息数量"""
+    """列出所有已收集的频道索引及其帖子数量"""
     if not update.message:
         return
     try:
-        files = [f for f in os.listdir(LINKS_DIR) if f.endswith('_links.txt')]
-        if not files:
+        files = os.listdir(LINKS_DIR)
+        index_channels = sorted(f[:-len('_index.meta.json')] for f in files if f.endswith('_index.meta.json'))
+        legacy_files = sorted(f for f in files
+                              if f.endswith('_links.txt') and f[:-len('_links.txt')] not in index_channels)
+        if not index_channels and not legacy_files:
             message = await update.message.reply_text('还没有收集任何频道数据。')
             await track_bot_message(update.effective_user.id, message)
             return
         lines = []
-        for fname in files:
+        for channel_name in index_channels:
+            # 数量直接取自索引元数据
+            meta = read_index_meta(channel_name) or {}
+            lines.append(f"@{channel_name} : {meta.get('count', 0)} 条（媒体 {meta.get('media_count', 0)} 条）")
+        for fname in legacy_files:
+            # 旧版纯链接文件没有元数据，只能逐行统计
             fpath = os.path.join(LINKS_DIR, fname)
-            count = 0
             with open(fpath, 'r', encoding='utf-8') as f:
                 count = sum(1 for _ in f if _.strip())
-            # 提取频道名并加@
             channel_name = fname.replace('_links.txt', '')
-            lines.append(f"@{channel_name} : {count} 条")
+            lines.append(f"@{channel_name} : {count} 条（旧格式）")
         msg = '已收集的频道数据：\n' + '\n'.join(lines)
         message = await update.message.reply_text(msg)
         await track_bot_message(update.effective_user.id, message)
@@ -1096,111 +2862,829 @@ async def listlinks_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         message = await update.message.reply_text(f'列出数据文件时出错: {str(e)}')
         await track_bot_message(update.effective_user.id, message)
 
+# ==================== 克隆任务断点日志 ====================
+
+JOURNAL_BATCH_SIZE = 50  # 累计多少条记录写盘一次
+JOURNAL_FLUSH_INTERVAL = 5.0  # 距上次写盘超过多少秒也会写盘
+
+def get_journal_file(job_name: str) -> str:
+    return os.path.join(LINKS_DIR, f"{job_name}.journal")
+
+class SendJournal:
+    """克隆任务的断点日志，每行一个已处理的帖子：{"pos": 帖子序号, "src": 源消息id, "dst": [目标消息id]}
+
+    发送失败的帖子 dst 为 null，续传时从最早失败的帖子重新开始。
+    记录先缓存在内存中，按批次追加写盘并 fsync，崩溃时最多重发最后一批。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.pending = []
+        self.last_flush = time.monotonic()
+
+    def load(self):
+        """读取整个日志，返回 (最后一条记录, 已处理的源消息 id 集合, 之后没有重试成功的失败记录列表)"""
+        last, done, failed = None, set(), {}
+        if not os.path.isfile(self.path):
+            return last, done, []
+        with open(self.path, encoding='utf-8', errors='ignore') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 最后一行可能在崩溃时只写了一半
+                    continue
+                last = record
+                if record.get('dst') is None:
+                    failed.setdefault(record['src'], record)
+                else:
+                    done.add(record['src'])
+                    failed.pop(record['src'], None)
+        return last, done, list(failed.values())
+
+    def record(self, pos: int, src_id: int, dst_ids) -> None:
+        self.pending.append(json.dumps({'pos': pos, 'src': src_id, 'dst': dst_ids}, separators=(',', ':')))
+        if (len(self.pending) >= JOURNAL_BATCH_SIZE
+                or time.monotonic() - self.last_flush >= JOURNAL_FLUSH_INTERVAL):
+            self.flush()
+
+    def flush(self) -> None:
+        self.last_flush = time.monotonic()
+        if not self.pending:
+            return
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write('\n'.join(self.pending) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.pending = []
+
+    def reset(self) -> None:
+        self.pending = []
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+def find_resume_position(posts: list, record, failed: list = ()) -> int:
+    """根据断点记录返回下一个待发送帖子的序号，有发送失败的帖子时返回最早失败的帖子的序号"""
+    if not record:
+        return 0
+    src_ids = None
+
+    def locate(record, after: bool) -> int:
+        nonlocal src_ids
+        pos = record.get('pos', -1)
+        # 正常情况下直接按序号定位；索引被重新收集过时按源消息 id 二分查找
+        if 0 <= pos < len(posts) and posts[pos][1] == record['src']:
+            return pos + 1 if after else pos
+        if src_ids is None:
+            src_ids = [post[1] for post in posts]
+        return (bisect.bisect_right if after else bisect.bisect_left)(src_ids, record['src'])
+
+    return min([locate(record, True)] + [locate(item, False) for item in failed])
+
+def load_sendto_posts(file_or_channel: str):
+    """读取待克隆的帖子列表 [(entity, message_id, member_ids), ...]，优先使用结构化索引，兼容旧版 *_links.txt
+
+    返回 (数据文件路径, 帖子列表)，文件不存在时帖子列表为 None
+    """
+    name = os.path.basename(file_or_channel)
+    if name.endswith('_index.jsonl'):
+        channel_name = name[:-len('_index.jsonl')]
+    elif name.endswith('_links.txt'):
+        channel_name = name[:-len('_links.txt')]
+    elif name.endswith('.txt'):
+        channel_name = None
+    else:
+        channel_name = safe_channel_name(file_or_channel)
+    if channel_name is not None:
+        meta = read_index_meta(channel_name)
+        if meta and os.path.isfile(get_index_file(channel_name)):
+            entity = meta['entity']
+            posts = [(entity, row['id'], row['members']) for row in iter_index_rows(channel_name)]
+            return get_index_file(channel_name), posts
+        file_name = get_links_file(channel_name)
+    else:
+        file_name = os.path.join(LINKS_DIR, name)
+    if not os.path.isfile(file_name):
+        return file_name, None
+    # 旧版纯链接文件，媒体组成员需要在发送时按前后10条查找
+    posts = []
+    with open(file_name, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                entity, message_id = parse_link(line.strip())
+                posts.append((entity, message_id, None))
+    return file_name, posts
+
+def upcoming_member_ids(posts: list, index: int, limit: int = PREFETCH_CHUNK) -> list:
+    """收集后续帖子的成员 id，用于在同一次 GetMessages 中预取"""
+    entity = posts[index][0]
+    ids = []
+    for next_index in range(index + 1, len(posts)):
+        next_entity, _, member_ids = posts[next_index]
+        if next_entity != entity or not member_ids or len(ids) + len(member_ids) > limit:
+            break
+        ids.extend(member_ids)
+    return ids
+
+# ==================== /sendto 流水线 ====================
+
+PIPELINE_QUEUE_SIZE = 20  # 相邻阶段之间最多缓冲的帖子数
+
+async def sendto_fetch_stage(posts: list, start_pos: int, out_queue: asyncio.Queue) -> None:
+    """流水线第一阶段：按源顺序获取每个帖子的消息，输出 (序号, 消息列表或 None)"""
+    for i in range(start_pos, len(posts)):
+        entity, message_id, member_ids = posts[i]
+        messages = None
+        if entity:
+            # 只在缓存未命中、需要发请求时才收集预取 id
+            prefetch_ids = None
+            if member_ids and not message_cache.contains(entity, member_ids):
+                prefetch_ids = upcoming_member_ids(posts, i)
+            # 限流等待和重试由共享限流器处理
+            try:
+                messages = await fetch_message_group(entity, message_id, member_ids, prefetch_ids)
+            except Exception as e:
+                logger.error(f"获取消息 {message_id} 失败: {e}")
+            if not messages:
+                logger.warning(f"未找到消息 ID {message_id}")
+        await out_queue.put((i, messages))
+    await out_queue.put(None)
+
+async def sendto_render_stage(in_queue: asyncio.Queue, out_queue: asyncio.Queue, rules: TextRules) -> None:
+    """流水线第二阶段：广告过滤和渲染，输出 (序号, 状态, 渲染结果或命中的关键词)"""
+    while True:
+        item = await in_queue.get()
+        if item is None:
+            await out_queue.put(None)
+            return
+        i, messages = item
+        if not messages:
+            await out_queue.put((i, 'missing', None))
+            continue
+        ad_keyword = is_ad_media_group(messages, rules)
+        if ad_keyword:
+            await out_queue.put((i, 'ad', ad_keyword))
+            continue
+        try:
+            post = render_post(messages, rules)
+        except Exception as e:
+            logger.error(f"渲染消息 {messages[0].id} 失败: {e}")
+            await out_queue.put((i, 'error', None))
+            continue
+        await out_queue.put((i, 'ok', post) if post else (i, 'empty', None))
+
+async def sendto_transfer_stage(in_queue: asyncio.Queue, out_queue: asyncio.Queue) -> None:
+    """流水线第三阶段：禁止转发的帖子提前下载并重新上传媒体，其他帖子直接传递"""
+    while True:
+        item = await in_queue.get()
+        if item is None:
+            await out_queue.put(None)
+            return
+        i, status, post = item
+        if status == 'ok' and post.protected and post.media_list:
+            try:
+                await transfer_post_media(post)
+            except Exception as e:
+                logger.error(f"中转媒体失败: {e}")
+                item = (i, 'error', None)
+        await out_queue.put(item)
+
+SENDTO_MAX_LAG = 50  # 多目标克隆时，最快的目标最多领先最慢的目标多少个帖子
+
+class SendtoTarget:
+    """/sendto 的一个目标频道：独立的发送队列、断点日志、去重和统计，限流状态按目标频道区分"""
+
+    def __init__(self, target_channel: str, posts: list, source_name: str):
+        self.target_channel = target_channel
+        self.posts = posts
+        self.journal = SendJournal(get_journal_file(f"{source_name}_to_{safe_channel_name(target_channel)}"))
+        self.start_pos = 0
+        self.done_ids = set()  # 续传时断点日志中已处理的源消息 id，不再发送
+        self.retry_count = 0  # 续传时重新发送的失败帖子数
+        self.dst_chat = None
+        self.queue = asyncio.Queue(maxsize=SENDTO_MAX_LAG)
+        self.position = 0
+        self.success_count = 0
+        self.fail_count = 0
+        self.skip_count = 0
+        self.dup_count = 0
+        self.ad_stats = Counter()  # 本次任务各广告关键词的跳过次数
+        # 连续的、无需改写的帖子攒成一批，用一次 forward_messages 转发
+        self.forward_batch = []
+        self.notify_flood = None
+        self.task = None  # 本目标的发送任务
+        self.error = None  # 发送任务异常结束的原因
+
+    async def put(self, item) -> bool:
+        """把帖子交给本目标的发送任务，队列满时等待；发送任务已经结束时返回 False，不再等待"""
+        if self.task.done():
+            return False
+        if not self.queue.full():
+            self.queue.put_nowait(item)
+            return True
+        put = asyncio.ensure_future(self.queue.put(item))
+        await asyncio.wait({put, self.task}, return_when=asyncio.FIRST_COMPLETED)
+        if put.done():
+            return True
+        put.cancel()
+        return False
+
+    def check_failed(self) -> bool:
+        """发送任务是否已异常结束，是则记录原因"""
+        if self.error is None and self.task.done() and not self.task.cancelled() and self.task.exception():
+            self.error = self.task.exception()
+            logger.error(f"目标 {self.target_channel} 的发送任务异常终止: {self.error}")
+        return self.error is not None
+
+    async def prepare(self) -> None:
+        # 目标频道已有的帖子先加入去重索引（只扫描上次之后的新消息）
+        self.dst_chat = await target_chat_id(self.target_channel)
+        if self.dst_chat is not None:
+            try:
+                seeded = await seed_dedup_index(self.target_channel)
+                if seeded:
+                    logger.info(f"已扫描目标频道 {self.target_channel}，去重索引新增 {seeded} 个帖子")
+            except Exception as e:
+                logger.warning(f"扫描目标频道 {self.target_channel} 失败: {e}")
+
+    def is_duplicate(self, post) -> bool:
+        return self.dst_chat is not None and (
+            dedup_index.contains(self.dst_chat, post.fingerprint)
+            or any(pending.fingerprint == post.fingerprint for _, pending in self.forward_batch))
+
+    async def record_result(self, i: int, post, result) -> None:
+        entity, message_id, _ = self.posts[i]
+        if result is None:
+            self.fail_count += 1
+            self.journal.record(i, message_id, None)
+            return
+        self.success_count += 1
+        self.journal.record(i, message_id, result)
+        if result and self.dst_chat is not None:
+            dedup_index.add(self.dst_chat, post.fingerprint, result[0])
+        await message_map.record(entity, post, self.target_channel, result)
+
+    async def flush_forward_batch(self) -> None:
+        if not self.forward_batch:
+            return
+        batch = self.forward_batch[:]
+        self.forward_batch.clear()
+        entity, message_id, _ = self.posts[batch[0][0]]
+        try:
+            results = await forward_post_batch(entity, [post for _, post in batch],
+                                               self.target_channel, on_flood=self.notify_flood)
+        except FLOOD_ERRORS:
+            logger.error(f"批量转发失败，已达到最大重试次数: {build_link(entity, message_id)}")
+            results = [None] * len(batch)
+        for (i, post), result in zip(batch, results):
+            await self.record_result(i, post, result)
+
+    async def process(self, item) -> None:
+        i, status, payload = item
+        self.position = i
+        entity, message_id, _ = self.posts[i]
+        if status == 'ok':
+            # 渲染结果由所有目标共享，中转、回退等状态变化只影响本目标
+            payload = copy.copy(payload)
+        if status == 'ok' and payload.forwardable and not self.is_duplicate(payload):
+            batch_size = sum(len(post.source_ids) for _, post in self.forward_batch)
+            if self.forward_batch and (self.posts[self.forward_batch[0][0]][0] != entity
+                                       or batch_size + len(payload.source_ids) > FORWARD_BATCH_SIZE):
+                await self.flush_forward_batch()
+            self.forward_batch.append((i, payload))
+            return
+        # 其他帖子发送或记录前先发出已攒的批次，保证断点日志按顺序记录
+        await self.flush_forward_batch()
+        if status == 'ad':
+            logger.info(f"检测到广告内容（关键词: {payload}），已跳过（message_id={message_id}）")
+            self.skip_count += 1
+            self.ad_stats[payload] += 1
+            self.journal.record(i, message_id, [])
+            return
+        if status == 'empty':
+            self.success_count += 1
+            self.journal.record(i, message_id, [])
+            return
+        if status != 'ok':
+            self.fail_count += 1
+            self.journal.record(i, message_id, None)
+            return
+        if self.is_duplicate(payload):
+            self.dup_count += 1
+            self.journal.record(i, message_id, [])
+            return
+        # 发送消息，限流等待和重试由共享限流器处理
+        try:
+            result = await send_rendered_post(payload, self.target_channel, on_flood=self.notify_flood)
+        except FLOOD_ERRORS:
+            result = None
+            logger.error(f"消息发送失败，已达到最大重试次数: {build_link(entity, message_id)}")
+        except Exception as e:
+            result = None
+            logger.error(f"发送消息时出错: {e}")
+        await self.record_result(i, payload, result)
+
+    async def run(self, stop: asyncio.Event) -> None:
+        """依次发送分发到本目标队列中的帖子，收到 None 或停止信号时结束"""
+        try:
+            while True:
+                item = await self.queue.get()
+                if item is None or stop.is_set():
+                    break
+                await self.process(item)
+            await self.flush_forward_batch()
+        finally:
+            self.journal.flush()
+
+    def summary(self) -> str:
+        summary = (f'成功: {self.success_count} 条，失败: {self.fail_count} 条，'
+                   f'广告跳过: {self.skip_count} 条，重复跳过: {self.dup_count} 条')
+        if self.error is not None:
+            summary += f'，发送任务异常终止: {self.error}，可使用 resume 参数继续'
+        return summary
+
+    def send_rate(self) -> float:
+        return sum(rate_limiter.current_rate((account.name, str(self.target_channel)))
+                   for account in sender_pool.accounts)
+
 async def sendto_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """从保存的频道消息链接文件中读取所有链接，依次转发到指定频道。支持直接输入频道名、@频道名、频道链接或txt文件名。"""
+    """从保存的频道索引中读取所有帖子，依次转发到一个或多个频道。支持直接输入频道名、@频道名、频道链接或数据文件名。
+
+    每个帖子只获取和渲染一次，再分发给各目标频道；每个目标有自己的发送任务和断点日志，
+    慢的目标最多落后 SENDTO_MAX_LAG 个帖子，超出时才会让其他目标等待。
+    """
     if not update.message:
         return
     await track_user_message(update)
     try:
         args = context.args if hasattr(context, 'args') else []
+        resume = len(args) > 2 and args[-1].lower() == 'resume'
+        if resume:
+            args = args[:-1]
         if len(args) < 2:
             message = await update.message.reply_text(
-                '用法: /sendto <链接文件名或频道名或频道链接或@频道名> <目标频道>\n'
-                '例如: /sendto yourchannel_links.txt @targetchannel\n'
-                '或: /sendto @yourchannel @targetchannel\n'
-                '或: /sendto https://t.me/yourchannel @targetchannel')
+                '用法: /sendto <频道名或频道链接或@频道名或数据文件名> <目标频道> [更多目标频道...] [resume]\n'
+                '例如: /sendto @yourchannel @targetchannel\n'
+                '或: /sendto https://t.me/yourchannel @targetchannel\n'
+                '或: /sendto yourchannel_links.txt @targetchannel\n'
+                '同时克隆到多个频道: /sendto @yourchannel @target1 @target2\n'
+                '中断后继续: /sendto @yourchannel @targetchannel resume')
             await track_bot_message(update.effective_user.id, message)
             return
         file_or_channel = args[0]
-        target_channel = args[1]
-        # 判断是否为txt文件，否则自动转为xxx_links.txt
-        if file_or_channel.endswith('.txt'):
-            file_name = os.path.join(LINKS_DIR, file_or_channel)
-        else:
-            channel_name = safe_channel_name(file_or_channel)
-            file_name = get_links_file(channel_name)
-        if not os.path.isfile(file_name):
+        target_channels = list(dict.fromkeys(args[1:]))
+        # 优先读取结构化索引，不存在时兼容旧版 xxx_links.txt
+        file_name, posts = load_sendto_posts(file_or_channel)
+        if posts is None:
             message = await update.message.reply_text(f'文件 {file_name} 不存在，请先用 /collectlinks 命令生成。')
             await track_bot_message(update.effective_user.id, message)
             return
-        # 读取所有链接
-        with open(file_name, 'r', encoding='utf-8') as f:
-            links = [line.strip() for line in f if line.strip()]
-        if not links:
+        if not posts:
             message = await update.message.reply_text(f'文件 {file_name} 没有可用的频道数据。')
             await track_bot_message(update.effective_user.id, message)
             return
-        message = await update.message.reply_text(f'开始向 {target_channel} 转发 {len(links)} 条消息，请耐心等待...\n如需中断，请发送 /stop')
+        # 每个 源->目标 组合一个断点日志
+        source_name = re.sub(r'(_index\.jsonl|_links\.txt|\.txt)$', '', os.path.basename(file_name))
+        targets = []
+        for target_channel in target_channels:
+            target = SendtoTarget(target_channel, posts, source_name)
+            if resume:
+                last, target.done_ids, failed = target.journal.load()
+                target.start_pos = find_resume_position(posts, last, failed)
+                target.retry_count = len(failed)
+                if all(post[1] in target.done_ids for post in posts[target.start_pos:]):
+                    continue
+            else:
+                target.journal.reset()
+            targets.append(target)
+        if not targets:
+            message = await update.message.reply_text(f'该任务已全部完成（共 {len(posts)} 条），无需继续。')
+            await track_bot_message(update.effective_user.id, message)
+            return
+        lines = []
+        for target in targets:
+            if target.start_pos:
+                remaining = sum(1 for post in posts[target.start_pos:] if post[1] not in target.done_ids)
+                line = f'从第 {target.start_pos + 1} 条继续向 {target.target_channel} 转发，剩余 {remaining} 条'
+                if target.retry_count:
+                    line += f'（含之前发送失败的 {target.retry_count} 条）'
+                lines.append(line)
+            else:
+                lines.append(f'开始向 {target.target_channel} 转发 {len(posts)} 条消息')
+        message = await update.message.reply_text('\n'.join(lines) + '，请耐心等待...\n如需中断，请发送 /stop')
         await track_bot_message(update.effective_user.id, message)
-        success_count = 0
-        fail_count = 0
+        for target in targets:
+            await target.prepare()
         user_id = update.effective_user.id
         user_stop_flags[user_id] = False  # 开始前重置
-        for i, link in enumerate(links):
-            # 检查是否收到停止指令
-            if user_stop_flags.get(user_id):
-                await update.message.reply_text("批量转发已被手动停止。")
-                user_stop_flags[user_id] = False  # 重置
-                break
-            
-            entity, message_id = parse_link(link)
-            if not entity:
-                fail_count += 1
-                continue
-            
-            # 尝试发送消息，自动处理限流
-            max_retries = 3
-            retry_count = 0
-            success = False
-            
-            while retry_count < max_retries and not success:
-                try:
-                    result = await send_message_to_channel(entity, message_id, target_channel)
-                    if result:
-                        success_count += 1
-                        success = True
-                    else:
-                        fail_count += 1
-                        success = True  # 标记为已处理，避免重试
-                except errors.FloodWaitError as e:
-                    retry_count += 1
-                    wait_time = e.seconds
-                    logger.warning(f"遇到限流，等待 {wait_time} 秒后重试 (第 {retry_count}/{max_retries} 次)")
-                    
-                    # 更新进度消息
-                    progress_msg = await update.message.reply_text(
-                        f'⏳ 遇到限流，等待 {wait_time} 秒后继续...\n'
-                        f'进度: {i+1}/{len(links)} | 成功: {success_count} | 失败: {fail_count}'
-                    )
-                    
-                    await asyncio.sleep(wait_time + 1)  # 等待限流时间 + 1秒缓冲
-                    
-                    # 删除进度消息
-                    try:
-                        await client.delete_messages(update.effective_user.id, progress_msg.message_id)
-                    except:
-                        pass
-                    
-                except Exception as e:
-                    logger.error(f"发送消息时出错: {e}")
-                    fail_count += 1
-                    success = True  # 标记为已处理
-            
-            if not success:
-                fail_count += 1
-                logger.error(f"消息发送失败，已达到最大重试次数: {link}")
-            
-            # 正常间隔（从配置读取，默认1秒）
-            delay = float(dynamic_config.get('delay_seconds', 1.0))
-            if delay > 0:
-                await asyncio.sleep(delay)  # 每条消息间隔，防止转发过快
-        message2 = await update.message.reply_text(f'转发完成！成功: {success_count} 条，失败: {fail_count} 条。')
+        rules = get_text_rules()  # 整个任务沿用同一份规则快照
+        start_pos = min(target.start_pos for target in targets)
+        stop = asyncio.Event()
+
+        def make_notify_flood(target):
+            async def notify_flood(wait_time):
+                """遇到限流时提示进度，等待结束后删除提示"""
+                progress_msg = await update.message.reply_text(
+                    f'⏳ {target.target_channel} 遇到限流，等待 {wait_time} 秒后继续...\n'
+                    f'进度: {target.position + 1}/{len(posts)} | 成功: {target.success_count} | 失败: {target.fail_count}'
+                )
+                asyncio.create_task(delete_message_later(user_id, progress_msg.message_id, wait_time + 1))
+            return notify_flood
+
+        for target in targets:
+            target.notify_flood = make_notify_flood(target)
+
+        # 获取 -> 渲染 -> 媒体中转 -> 分发 -> 各目标发送，各阶段通过有界队列连接，发送端等待间隔时后续帖子已在准备
+        fetch_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        render_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        transfer_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        stages = [
+            asyncio.create_task(sendto_fetch_stage(posts, start_pos, fetch_queue)),
+            asyncio.create_task(sendto_render_stage(fetch_queue, render_queue, rules)),
+            asyncio.create_task(sendto_transfer_stage(render_queue, transfer_queue)),
+        ]
+        for target in targets:
+            target.task = asyncio.create_task(target.run(stop))
+        senders = [target.task for target in targets]
+        active = list(targets)
+        try:
+            while active:
+                item = await transfer_queue.get()
+                if item is None:
+                    break
+                # 检查是否收到停止指令
+                if user_stop_flags.get(user_id):
+                    stop.set()
+                    await update.message.reply_text("批量转发已被手动停止，可使用 resume 参数继续。")
+                    user_stop_flags[user_id] = False  # 重置
+                    break
+                for target in list(active):
+                    # 目标队列已满说明该目标落后太多，在这里等待它；发送任务已异常结束的目标不再分发
+                    if (item[0] >= target.start_pos and posts[item[0]][1] not in target.done_ids
+                            and not await target.put(item)):
+                        target.check_failed()
+                        active.remove(target)
+            for target in active:
+                if not stop.is_set():
+                    await target.put(None)
+                elif not target.queue.full():
+                    # 停止时队列中还有帖子的目标会在取下一个帖子时看到停止信号
+                    target.queue.put_nowait(None)
+            await asyncio.gather(*senders, return_exceptions=True)
+            for target in targets:
+                target.check_failed()
+        finally:
+            for task in stages + senders:
+                task.cancel()
+        if len(targets) == 1:
+            target = targets[0]
+            summary = f'转发完成！{target.summary()}。'
+        else:
+            summary = '转发完成！\n' + '\n'.join(f'{target.target_channel}: {target.summary()}' for target in targets)
+        send_rate = sum(target.send_rate() for target in targets)
+        summary += f'\n当前发送速率: {send_rate:.2f} 条/秒，{rate_limiter.summary().splitlines()[0]}'
+        if len(sender_pool.accounts) > 1:
+            summary += f'\n{sender_pool.summary()}'
+        # 各目标的起始位置可能不同（续传），命中次数按目标分别统计
+        for target in targets:
+            if target.ad_stats:
+                top = '、'.join(f'{kw}×{n}' for kw, n in target.ad_stats.most_common(5))
+                label = f'{target.target_channel} ' if len(targets) > 1 else ''
+                summary += f'\n{label}命中关键词: {top}'
+        message2 = await update.message.reply_text(summary)
         await track_bot_message(update.effective_user.id, message2)
     except Exception as e:
         logger.error(f'/sendto 批量转发命令处理错误: {e}')
         message = await update.message.reply_text(f'批量转发消息时出错: {str(e)}')
         await track_bot_message(update.effective_user.id, message)
 
+# ==================== 实时镜像 ====================
+
+MIRROR_ALBUM_WAIT = 1.5  # 媒体组最后一部分到达后再等待的秒数，之后整组一次发送
+MIRROR_CATCHUP_INTERVAL = 60  # 每隔多少秒检查一次是否有漏掉的消息（断线重连后据此补齐）
+MIRROR_FETCH_RETRIES = 3  # 机器人读取新消息失败时的重试次数
+MIRROR_STATE_FILE = os.path.join(LINKS_DIR, 'mirrors.json')
+
+# 运行中的镜像任务，键为 源_to_目标
+live_mirrors = {}
+
+def save_mirror_state() -> None:
+    """保存所有镜像任务及其最后处理的源消息 id，重启后自动恢复"""
+    state = {key: {'source': mirror.source, 'target': mirror.target, 'last_id': mirror.last_id}
+             for key, mirror in live_mirrors.items()}
+    tmp_file = MIRROR_STATE_FILE + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp_file, MIRROR_STATE_FILE)
+
+class LiveMirror:
+    """监听源频道的新消息，实时克隆到目标频道。
+
+    用户客户端接收新消息事件，媒体组的各部分先在内存中缓冲，收齐后作为一个帖子进入发送队列；
+    发送沿用 /sendto 的文本规则、广告过滤和发送池。定期从最后处理的 id 之后补齐漏掉的消息。
+    """
+
+    def __init__(self, source, target: str, last_id: int = 0):
+        self.source = source
+        self.target = target
+        self.last_id = last_id  # 最后一条已处理（发送、跳过或失败）的源消息 id
+        self.seen_id = last_id  # 已进入缓冲区或发送队列的最大 id
+        self.entity = None
+        self.album = []  # 正在等待其余部分的媒体组
+        self.album_timer = None
+        self.queue = asyncio.Queue()
+        self.tasks = []
+        self.sent = 0
+        self.skipped = 0
+        self.failed = 0
+        self.ad_stats = Counter()
+
+    @property
+    def key(self) -> str:
+        return f"{safe_channel_name(str(self.source))}_to_{safe_channel_name(self.target)}"
+
+    async def start(self) -> None:
+        self.entity = await entity_resolver.resolve(user_client, self.source)
+        if not self.last_id:
+            # 新建的镜像只同步之后发布的消息，历史消息用 /sendto 克隆
+            latest = await user_client.get_messages(self.entity, limit=1)
+            self.last_id = self.seen_id = latest[0].id if latest else 0
+        user_client.add_event_handler(self.on_new_message, events.NewMessage(chats=self.entity))
+        asyncio.create_task(self.seed_target())
+        self.tasks = [asyncio.create_task(self.send_loop()), asyncio.create_task(self.catch_up_loop())]
+
+    async def seed_target(self) -> None:
+        """把目标频道已有的帖子加入去重索引"""
+        try:
+            await seed_dedup_index(self.target)
+        except Exception as e:
+            logger.warning(f"扫描目标频道 {self.target} 失败: {e}")
+
+    def stop(self) -> None:
+        user_client.remove_event_handler(self.on_new_message)
+        if self.album_timer:
+            self.album_timer.cancel()
+        for task in self.tasks:
+            task.cancel()
+
+    async def on_new_message(self, event) -> None:
+        self.feed(event.message)
+
+    def feed(self, msg) -> None:
+        """接收一条新消息：媒体组的部分进入缓冲区，其他消息直接进入发送队列"""
+        if msg.id <= self.seen_id:
+            return
+        self.seen_id = msg.id
+        if self.album and msg.grouped_id and msg.grouped_id == self.album[0].grouped_id:
+            self.album.append(msg)
+        else:
+            # 同一频道的媒体组是连续发布的，出现其他消息说明上一组已经收齐
+            self.flush_album()
+            if not msg.grouped_id:
+                self.queue.put_nowait([msg])
+                return
+            self.album = [msg]
+        if self.album_timer:
+            self.album_timer.cancel()
+        self.album_timer = asyncio.get_running_loop().call_later(MIRROR_ALBUM_WAIT, self.flush_album)
+
+    def flush_album(self) -> None:
+        if self.album_timer:
+            self.album_timer.cancel()
+            self.album_timer = None
+        if self.album:
+            self.queue.put_nowait(self.album)
+            self.album = []
+
+    async def send_loop(self) -> None:
+        while True:
+            messages = await self.queue.get()
+            member_ids = sorted(msg.id for msg in messages)
+            # 缓存中可能有发布前记录的"不存在"，重新获取；机器人有时要稍等才能读到新消息
+            fetched = None
+            for attempt in range(MIRROR_FETCH_RETRIES):
+                for mid in member_ids:
+                    message_cache.invalidate(self.source, mid)
+                try:
+                    fetched = await fetch_message_group(self.source, member_ids[0], member_ids)
+                except Exception as e:
+                    logger.warning(f"镜像 {self.key} 获取消息失败: {e}")
+                if fetched:
+                    break
+                await asyncio.sleep(MIRROR_ALBUM_WAIT)
+            if not fetched:
+                # 不推进 last_id，重启后从这里补齐
+                logger.warning(f"镜像 {self.key} 获取消息 {member_ids} 失败")
+                self.failed += 1
+                continue
+            skipped_before = sum(self.ad_stats.values())
+            while True:
+                try:
+                    # 由机器人重新获取消息，保证媒体的 file reference 对发送账号有效
+                    sent_ids = await send_message_to_channel(self.source, member_ids[0], self.target,
+                                                             rules=get_text_rules(), ad_stats=self.ad_stats,
+                                                             member_ids=member_ids)
+                    break
+                except FLOOD_ERRORS as e:
+                    logger.warning(f"镜像 {self.key} 遇到限流，等待 {e.seconds} 秒")
+                    await asyncio.sleep(e.seconds)
+            if sum(self.ad_stats.values()) > skipped_before:
+                self.skipped += 1
+            elif sent_ids is None:
+                self.failed += 1
+            else:
+                self.sent += 1
+            self.last_id = max(self.last_id, member_ids[-1])
+            save_mirror_state()
+
+    async def catch_up(self) -> None:
+        """补齐 seen_id 之后没有通过事件收到的消息（启动、断线重连后）"""
+        from telethon.tl.types import Message
+
+        if not user_client.is_connected():
+            return
+        async for msg in user_client.iter_messages(self.entity, reverse=True, min_id=self.seen_id):
+            if isinstance(msg, Message):
+                self.feed(msg)
+
+    async def catch_up_loop(self) -> None:
+        while True:
+            try:
+                await self.catch_up()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"镜像 {self.key} 补齐消息失败: {e}")
+            await asyncio.sleep(MIRROR_CATCHUP_INTERVAL)
+
+    def status(self) -> str:
+        return (f"{self.source} → {self.target} | 最后 id {self.last_id} | 已发送 {self.sent} | "
+                f"跳过广告 {self.skipped} | 失败 {self.failed} | 待发送 {self.queue.qsize()}")
+
+async def restore_mirrors() -> None:
+    """启动时恢复上次运行中的镜像任务，从最后处理的 id 继续"""
+    if not os.path.isfile(MIRROR_STATE_FILE):
+        return
+    with open(MIRROR_STATE_FILE, 'r', encoding='utf-8') as f:
+        state = json.load(f)
+    for key, item in state.items():
+        mirror = LiveMirror(item['source'], item['target'], item.get('last_id', 0))
+        try:
+            await mirror.start()
+            live_mirrors[key] = mirror
+            print(f"✅ 已恢复镜像 {item['source']} → {item['target']}")
+        except Exception as e:
+            print(f"⚠️  恢复镜像 {item['source']} → {item['target']} 失败: {e}")
+
+# ==================== 编辑和删除同步 ====================
+
+async def edit_target_message(dst_chat: int, dst_id: int, text: str, entities: list, sender: str = None) -> None:
+    """用发出该消息的账号修改目标频道中的一条消息，实体无效时与发送时一样改用 HTML"""
+    try:
+        await sender_pool.call(dst_chat, 'edit_message', dst_chat, dst_id, text, sender=sender,
+                               formatting_entities=entities if entities else None)
+    except errors.MessageNotModifiedError:
+        pass
+    except FLOOD_ERRORS:
+        raise
+    except Exception:
+        await sender_pool.call(dst_chat, 'edit_message', dst_chat, dst_id, convert_to_html(text, entities),
+                               sender=sender, parse_mode='html')
+
+async def on_source_edited(event) -> None:
+    """源消息被编辑：按当前文本规则重新渲染整个帖子，修改目标频道中对应的消息"""
+    records = message_map.lookup(event.chat_id, event.message.id)
+    if not records:
+        return
+    members = records[0][3]
+    try:
+        if len(members) > 1:
+            chat = await event.get_input_chat()
+            messages = await limited_call(user_client, chat, user_client.get_messages, chat, ids=members)
+            messages = sorted((msg for msg in messages if msg), key=lambda x: x.id)
+        else:
+            messages = [event.message]
+        rules = get_text_rules()
+        post = None if is_ad_media_group(messages, rules) else render_post(messages, rules)
+    except Exception as e:
+        logger.error(f"处理源消息编辑失败: {e}")
+        return
+    for post_id, dst_chat, pairs, _, sender in records:
+        try:
+            if post is None:
+                # 编辑后命中广告关键词，删除目标频道中的整个帖子
+                await sender_pool.call(dst_chat, 'delete_messages', dst_chat, [dst_id for _, dst_id in pairs],
+                                       sender=sender)
+                message_map.remove_post(event.chat_id, post_id, dst_chat)
+                continue
+            await edit_target_message(dst_chat, pairs[0][1], post.text, post.entities, sender)
+            extra_ids = [dst_id for src_id, dst_id in pairs if src_id == 0]
+            for dst_id, (extra_text, extra_entities) in zip(extra_ids, post.extra):
+                await edit_target_message(dst_chat, dst_id, extra_text, extra_entities, sender)
+            if len(post.extra) > len(extra_ids):
+                logger.warning(f"编辑后文本需要更多消息，超出部分未同步: {event.chat_id}/{event.message.id}")
+            elif len(post.extra) < len(extra_ids):
+                # 编辑后文本变短，删除多出来的单独发送的剩余文本
+                surplus = extra_ids[len(post.extra):]
+                await sender_pool.call(dst_chat, 'delete_messages', dst_chat, surplus, sender=sender)
+                message_map.save(event.chat_id, post_id, dst_chat,
+                                 [pair for pair in pairs if pair[1] not in surplus], members, sender)
+            logger.info(f"已同步编辑: {event.chat_id}/{event.message.id} -> {dst_chat}/{pairs[0][1]}")
+        except Exception as e:
+            logger.error(f"同步编辑到 {dst_chat} 失败: {e}")
+
+async def on_source_deleted(event) -> None:
+    """源消息被删除：删除目标频道中对应的消息，帖子的源消息全部删除时连同超长文本一起删除"""
+    if not event.chat_id:
+        # 私聊和普通群组的删除事件不带会话 id，无法对应到源频道
+        return
+    src_chat = event.chat_id
+    deleted = set(event.deleted_ids)
+    posts = {}
+    for src_id in deleted:
+        for record in message_map.lookup(src_chat, src_id):
+            posts[(record[0], record[1])] = record
+    if not posts:
+        return
+    to_delete = {}
+    for post_id, dst_chat, pairs, members, sender in posts.values():
+        remaining = [pair for pair in pairs if pair[0] not in deleted]
+        # 按 (目标频道, 发送账号) 分组，每组由发出消息的账号删除
+        if any(src_id for src_id, _ in remaining):
+            to_delete.setdefault((dst_chat, sender), []).extend(
+                dst_id for src_id, dst_id in pairs if src_id in deleted)
+            message_map.save(src_chat, post_id, dst_chat, remaining, [i for i in members if i not in deleted],
+                             sender)
+        else:
+            to_delete.setdefault((dst_chat, sender), []).extend(dst_id for _, dst_id in pairs)
+            message_map.remove_post(src_chat, post_id, dst_chat)
+    message_map.remove_members(src_chat, list(deleted))
+    for (dst_chat, sender), dst_ids in to_delete.items():
+        if not dst_ids:
+            continue
+        try:
+            await sender_pool.call(dst_chat, 'delete_messages', dst_chat, dst_ids, sender=sender)
+            logger.info(f"已同步删除: {src_chat} -> {dst_chat} 的 {len(dst_ids)} 条消息")
+        except Exception as e:
+            logger.error(f"同步删除到 {dst_chat} 失败: {e}")
+
+async def start_user_services() -> None:
+    """用户客户端就绪后：监听源消息的编辑和删除，恢复实时镜像任务"""
+    user_client.add_event_handler(on_source_edited, events.MessageEdited())
+    user_client.add_event_handler(on_source_deleted, events.MessageDeleted())
+    await restore_mirrors()
+
+async def mirror_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """开始、停止或查看实时镜像任务"""
+    if not update.message:
+        return
+    await track_user_message(update)
+    args = context.args if hasattr(context, 'args') else []
+    if not args:
+        lines = ['用法: /mirror <源频道> <目标频道>\n例如: /mirror @yourchannel @targetchannel\n'
+                 '停止: /mirror stop <源频道> [目标频道]']
+        if live_mirrors:
+            lines.append(f'\n🔁 运行中的镜像（{len(live_mirrors)} 个）：')
+            lines.extend(mirror.status() for mirror in live_mirrors.values())
+        message = await update.message.reply_text('\n'.join(lines))
+        await track_bot_message(update.effective_user.id, message)
+        return
+    if not USER_CLIENT_READY:
+        message = await update.message.reply_text('❌ 用户客户端未启动，无法监听源频道的新消息。')
+        await track_bot_message(update.effective_user.id, message)
+        return
+    try:
+        if args[0].lower() == 'stop' and len(args) > 1:
+            source = parse_channel_input(args[1])
+            stopped = [key for key, mirror in live_mirrors.items()
+                       if mirror.source == source and (len(args) < 3 or mirror.target == args[2])]
+            for key in stopped:
+                live_mirrors.pop(key).stop()
+            save_mirror_state()
+            message = await update.message.reply_text(f'已停止 {len(stopped)} 个镜像任务。')
+            await track_bot_message(update.effective_user.id, message)
+            return
+        if len(args) < 2:
+            message = await update.message.reply_text('用法: /mirror <源频道> <目标频道>')
+            await track_bot_message(update.effective_user.id, message)
+            return
+        mirror = LiveMirror(parse_channel_input(args[0]), args[1])
+        if mirror.key in live_mirrors:
+            message = await update.message.reply_text(f'{args[0]} → {args[1]} 的镜像已在运行。')
+            await track_bot_message(update.effective_user.id, message)
+            return
+        await mirror.start()
+        live_mirrors[mirror.key] = mirror
+        save_mirror_state()
+        message = await update.message.reply_text(
+            f'🔁 已开始镜像 {args[0]} → {args[1]}，之后发布的新消息会实时克隆（从消息 id {mirror.last_id} 之后开始）。\n'
+            f'历史消息请用 /collectlinks 和 /sendto 克隆。')
+        await track_bot_message(update.effective_user.id, message)
+    except Exception as e:
+        logger.error(f'/mirror 命令处理错误: {e}')
+        message = await update.message.reply_text(f'启动镜像失败: {str(e)}')
+        await track_bot_message(update.effective_user.id, message)
+
 async def post_init(app: Application) -> None:
     """在 PTB 应用启动后初始化 Telethon 客户端"""
     global USER_CLIENT_READY
@@ -1221,6 +3705,8 @@ async def post_init(app: Application) -> None:
             BotCommand("listlinks", "查看已收集的频道数据"),
             BotCommand("sendto", "克隆频道到目标频道"),
             BotCommand("stop", "停止批量转发任务"),
+            BotCommand("pool", "查看发送账号状态"),
+            BotCommand("mirror", "实时镜像频道新消息"),
             BotCommand("config", "管理文本处理配置"),
             BotCommand("testconfig", "测试文本处理效果")
         ]
@@ -1236,18 +3722,24 @@ async def post_init(app: Application) -> None:
             with open('config.json', 'r', encoding='utf-8') as f:
                 loaded_config = json.load(f)
                 dynamic_config.update(loaded_config)
+            refresh_text_rules()
+            rate_limiter.configure(dynamic_config)
             print("✅ 已加载保存的配置")
         else:
             print("ℹ️  未找到 config.json，使用默认配置")
     except Exception as e:
         print(f"⚠️  加载配置失败: {e}")
     
+    # 启动额外的发送账号
+    await start_sender_pool(dynamic_config)
+    
     # 启动用户客户端
     print("正在启动用户客户端...")
     try:
         await user_client.start()
         print("✅ 用户客户端启动成功")
         USER_CLIENT_READY = True
+        await start_user_services()
     except errors.SessionPasswordNeededError:
         print("⚠️  检测到两步验证，请输入你的两步验证密码：")
         password = input("请输入两步验证密码: ")
@@ -1255,6 +3747,7 @@ async def post_init(app: Application) -> None:
             await user_client.sign_in(password=password)
             USER_CLIENT_READY = True
             print("✅ 两步验证成功！")
+            await start_user_services()
         except Exception as e2:
             print(f"❌ 两步验证失败: {e2}")
             print("机器人将无法使用 /collectlinks 功能")
@@ -1266,7 +3759,10 @@ async def post_init(app: Application) -> None:
 
 async def post_stop(app: Application) -> None:
     """在 PTB 应用停止后清理 Telethon 客户端"""
+    message_tracker.flush()
     await client.disconnect()
+    for account in sender_pool.accounts[1:]:
+        await account.client.disconnect()
     if USER_CLIENT_READY:
         await user_client.disconnect()
 
@@ -1296,6 +3792,8 @@ def main() -> None:
     application.add_handler(CommandHandler("listlinks", listlinks_command))
     application.add_handler(CommandHandler("sendto", sendto_command))
     application.add_handler(CommandHandler("stop", stop_command))
+    application.add_handler(CommandHandler("pool", pool_command))
+    application.add_handler(CommandHandler("mirror", mirror_command))
     
     # 添加动态配置管理命令处理器
     application.add_handler(CommandHandler("config", config_command))